@@ -0,0 +1,177 @@
+"""End-to-end benchmark of hki_sig_ml.inference.classify
+
+Generates synthetic scanned PDFs offline and classifies them with a
+randomly initialized model for each architecture. Every case runs in a
+fresh process, so the peak memory is per case. The report is JSON with
+latency percentiles, throughput and the time per pipeline stage, and
+can be compared against an earlier report:
+
+    python benchmarks/classify.py --output before.json
+    python benchmarks/classify.py --output after.json --compare before.json
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+MODELS = ['resnet18', 'resnet34', 'mobilenet_v2']
+
+# Page sizes in inches
+PAGE_SIZES = {'a4': (8.27, 11.69),
+              'a4-landscape': (11.69, 8.27),
+              'letter': (8.5, 11.),
+              'a3': (11.69, 16.54),
+              'a5': (5.83, 8.27)}
+
+
+def synthetic_page(page_size:str='a4', dpi:int=150, signature:bool=False, rng=None):
+    # A white page with lines of word-like blocks and optionally a
+    # scribbled signature near the bottom
+    rng = np.random.default_rng() if rng is None else rng
+    width, height = (int(inches*dpi) for inches in PAGE_SIZES[page_size])
+    page = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(page)
+    margin, line_height = dpi, max(2, int(dpi*0.16))
+    for y in range(margin, height - 2*margin, line_height):
+        x = margin
+        line_end = width - margin - rng.integers(0, width//3)
+        while x < line_end:
+            word = int(rng.integers(dpi//10, dpi//2))
+            draw.rectangle([x, y, min(x + word, line_end), y + line_height//2],
+                           fill=int(rng.integers(0, 80)))
+            x += word + dpi//12
+    if signature:
+        x0, y0 = rng.integers(margin, width//2), height - 2*margin + rng.integers(0, margin)
+        points = [(int(x0 + i*dpi/20), int(y0 + rng.normal(0, dpi/10))) for i in range(30)]
+        draw.line(points, fill=0, width=max(1, dpi//40))
+    return page.convert('RGB')
+
+
+def synthetic_pdf(num_pages:int, page_size:str='a4', dpi:int=150, seed:int=0):
+    rng = np.random.default_rng(seed)
+    pages = [synthetic_page(page_size, dpi, rng.random() < 0.3, rng)
+             for _ in range(num_pages)]
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format='PDF', save_all=True, append_images=pages[1:],
+                  resolution=dpi)
+    return buffer.getvalue()
+
+
+def percentiles(values):
+    return {'mean': float(np.mean(values)),
+            'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)),
+            'p99': float(np.percentile(values, 99))}
+
+
+def run_case(model:str, num_pages:int, page_size:str, dpi:int, repeat:int,
+             batch_size:int, seed:int):
+    import torch
+    from hki_sig_ml.inference import classify, create_inference_model
+    from hki_sig_ml.metrics import METRICS, StageTimings
+
+    torch.manual_seed(seed)
+    learner = create_inference_model(None, model=model)
+    pdf_documents = [{'filename': 'synthetic.pdf',
+                      'bytes': synthetic_pdf(num_pages, page_size, dpi, seed)}]
+
+    # Warm up
+    classify(pdf_documents, learner, batch_size=batch_size)
+
+    latencies = []
+    stages = {}
+    tiles = METRICS.counters['tiles']
+    for _ in range(repeat):
+        with StageTimings(metrics=None) as timings:
+            t0 = time.perf_counter()
+            classify(pdf_documents, learner, batch_size=batch_size)
+            latencies.append(time.perf_counter() - t0)
+        for stage, seconds in timings.durations.items():
+            stages.setdefault(stage, []).append(seconds)
+    tiles = (METRICS.counters['tiles'] - tiles)/repeat
+
+    return {'model': model,
+            'pages': num_pages,
+            'page_size': page_size,
+            'dpi': dpi,
+            'batch_size': batch_size,
+            'torch': torch.__version__,
+            'tiles': tiles,
+            'latency_s': percentiles(latencies),
+            'pages_per_s': num_pages/np.mean(latencies),
+            'tiles_per_s': tiles/np.mean(latencies),
+            'stages_s': {stage: float(np.mean(seconds)) for stage, seconds in stages.items()},
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024}
+
+
+def case_key(case:dict):
+    return (case['model'], case['pages'], case['page_size'], case['dpi'], case['batch_size'])
+
+
+def compare(report:dict, baseline:dict):
+    # Ratios of this report to the baseline for the cases in both
+    baseline = {case_key(case): case for case in baseline['cases']}
+    comparison = []
+    for case in report['cases']:
+        before = baseline.get(case_key(case))
+        if before is None:
+            continue
+        comparison.append({'case': dict(zip(['model', 'pages', 'page_size', 'dpi', 'batch_size'],
+                                            case_key(case))),
+                           'pages_per_s_ratio': case['pages_per_s']/before['pages_per_s'],
+                           'p50_latency_ratio': case['latency_s']['p50']/before['latency_s']['p50'],
+                           'peak_rss_ratio': case['peak_rss_mb']/before['peak_rss_mb']})
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--models', nargs='+', default=MODELS, choices=MODELS)
+    parser.add_argument('--pages', nargs='+', type=int, default=[1, 10, 50])
+    parser.add_argument('--page-sizes', nargs='+', default=['a4'], choices=list(PAGE_SIZES))
+    parser.add_argument('--dpi', nargs='+', type=int, default=[150],
+                        help='Resolution of the synthetic scanned pages')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write the JSON report here instead of stdout')
+    parser.add_argument('--compare', default=None, help='Earlier JSON report to compare against')
+    args = parser.parse_args()
+
+    cases = []
+    for model, num_pages, page_size, dpi in itertools.product(args.models, args.pages,
+                                                              args.page_sizes, args.dpi):
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            case = pool.submit(run_case, model, num_pages, page_size, dpi, args.repeat,
+                               args.batch_size, args.seed).result()
+        print(f"{model} {num_pages}p {page_size} {dpi}dpi: "
+              f"{case['pages_per_s']:.2f} pages/s, p50 {case['latency_s']['p50']:.3f} s",
+              file=sys.stderr)
+        cases.append(case)
+
+    report = {'environment': {'python': platform.python_version(),
+                              'platform': platform.platform(),
+                              'cpu_count': os.cpu_count()},
+              'arguments': vars(args),
+              'cases': cases}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            report['comparison'] = compare(report, json.load(f))
+
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
@@ -0,0 +1,144 @@
+"""Microbenchmark of the tile aggregation functions
+
+Compares the vectorized distill_results / distill_details against the
+previous row-by-row implementations on synthetic tile frames and checks
+that both give the same output, including for failed documents.
+
+    python benchmarks/distill.py --documents 100 --pages 50 --tiles 6
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from hki_sig_ml.inference import distill_details, distill_results
+
+
+def distill_results_iterrows(df: pd.DataFrame, errors: pd.DataFrame=None):
+    res = {}
+    for i,row in df.iterrows():
+        index = row.document
+        if index not in res:
+            res[index] = {'document': row.document,
+                          'status': 'OK',
+                          'message': '',
+                          'num_pages': 1,
+                          'positive': [row.page] if row.label == 'True' else []}
+        else:
+            new_pages = res[index]['num_pages'] if row.page <= res[index]['num_pages'] else row.page
+            if row.label == 'True' and int(row.page):
+                new_positives = res[index]['positive'] + [int(row.page)]
+            else:
+                new_positives = res[index]['positive']
+            res[index] = {**res[index],
+                          'num_pages': int(new_pages),
+                          'positive': sorted(list(set(new_positives)))}
+
+    if errors is not None:
+        for i,row in errors.iterrows():
+            res[row.document] = {'document': row.document, 
+                                 'status': 'ERROR', 
+                                 'message': '', 
+                                 'num_pages': -1, 
+                                 'positive': []}
+
+    return pd.DataFrame(res.values())
+
+
+def distill_details_iterrows(info: pd.DataFrame, errors: pd.DataFrame=None):
+    res = {}
+    for i,row in info.iterrows():
+        index = (row.document, row.page)
+        if index not in res:
+            res[index] = {'document': row.document,
+                          'status': 'OK',
+                          'page': row.page,
+                          'label': row.label,
+                          'confidence': row.confidence}
+        if res[index]['label'] == 'False' and row.label == 'True':
+            res[index] = {**res[index],
+                          'label': row.label,
+                          'confidence': row.confidence}
+        if res[index]['label'] == row.label == 'False' and res[index]['confidence'] > row.confidence:
+            res[index] = {**res[index],
+                          'confidence': row.confidence}
+        if res[index]['label'] == row.label == 'True' and res[index]['confidence'] < row.confidence:
+            res[index] = {**res[index],
+                          'confidence': row.confidence}
+
+    if errors is not None:
+        for i,row in errors.iterrows():
+            res[(row.document,)] = {'document': row.document, 
+                                    'status': 'ERROR'}
+
+    df = pd.DataFrame(res.values())
+    df = df.astype(object).where(df.notna(), None)
+
+    return df
+
+
+def synthetic_tiles(documents:int, pages:int, tiles:int, positive_prob:float=0.05,
+                    seed:int=0):
+    # Tile frame in the (document, page, tile) order produced by
+    # split_documents, with random labels and confidences
+    rng = np.random.default_rng(seed)
+    n = documents*pages*tiles
+    return pd.DataFrame({'document': np.repeat([f'document_{i}.pdf' for i in range(documents)], 
+                                               pages*tiles),
+                         'page': np.tile(np.repeat(np.arange(1, pages+1), tiles), documents),
+                         'tile': np.tile(np.arange(1, tiles+1), documents*pages),
+                         'label': np.where(rng.random(n) < positive_prob, 'True', 'False'),
+                         'confidence': rng.uniform(0.5, 1.0, n)})
+
+
+def check_marshallable(details: pd.DataFrame):
+    # The API marshals page as an integer and confidence as a float, with
+    # missing values (failed documents) as None
+    for row in details.to_dict(orient='records'):
+        for column, cast in [('page', int), ('confidence', float)]:
+            if row[column] is not None:
+                cast(row[column])
+        if row['status'] == 'ERROR':
+            assert row['page'] is None and row['confidence'] is None, row
+
+
+def best_time(f, *args, repeat:int=3):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f(*args)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=20)
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--tiles', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    info = synthetic_tiles(args.documents, args.pages, args.tiles)
+    # A document that fails after its first page was tiled, and one that
+    # cannot be opened at all, after the documents that have tiles
+    broken = synthetic_tiles(1, 1, args.tiles, seed=1).assign(document='broken.pdf')
+    info = pd.concat([info, broken], ignore_index=True)
+    errors = pd.DataFrame([{'document': 'broken.pdf', 'error': 'synthetic'},
+                           {'document': 'unreadable.pdf', 'error': 'synthetic'}])
+    print(f'{len(info)} tiles in {args.documents} documents')
+
+    for name, reference, vectorized in [
+            ('distill_results', distill_results_iterrows, distill_results),
+            ('distill_details', distill_details_iterrows, distill_details)]:
+        result = vectorized(info, errors).reset_index(drop=True)
+        pd.testing.assert_frame_equal(reference(info, errors).reset_index(drop=True),
+                                      result, check_dtype=False)
+        if name == 'distill_details':
+            check_marshallable(result)
+        t_reference = best_time(reference, info, errors, repeat=args.repeat)
+        t_vectorized = best_time(vectorized, info, errors, repeat=args.repeat)
+        print(f'{name}: iterrows {t_reference*1000:.1f} ms, '
+              f'vectorized {t_vectorized*1000:.1f} ms, '
+              f'speedup {t_reference/t_vectorized:.1f}x')
@@ -0,0 +1,60 @@
+"""Import time profile of the server and the model libraries
+
+Imports each module in a fresh interpreter with python -X importtime and
+reports the total time and the slowest top level imports as JSON:
+
+    python benchmarks/importtime.py --modules wsgi hki_sig_ml.inference fastai.vision.all
+
+The server is imported with HKI_FAST_START=1, so the time is what it
+takes until /health answers. With --budget, the script fails if the
+first module takes longer than that many seconds to import.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+def parse_importtime(log:str):
+    # (module, self seconds, cumulative seconds, depth) per import from
+    # the -X importtime output
+    imports = []
+    for line in log.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1)//2
+        imports.append((name.strip(), int(self_us)/1e6, int(cumulative_us)/1e6, depth))
+    return imports
+
+
+def profile(module:str, top:int=20):
+    env = dict(os.environ, HKI_FAST_START='1')
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                             env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed:\n{process.stderr}')
+    imports = parse_importtime(process.stderr)
+    top_level = sorted((item for item in imports if item[3] == 0),
+                       key=lambda item: -item[2])
+    return {'module': module,
+            'total_s': sum(item[2] for item in top_level),
+            'imports': len(imports),
+            'slowest': [{'module': name, 'cumulative_s': cumulative, 'self_s': self_s}
+                        for name, self_s, cumulative, _ in top_level[:top]]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modules', nargs='+', default=['wsgi'])
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Maximum import time in seconds for the first module')
+    args = parser.parse_args()
+
+    report = [profile(module, args.top) for module in args.modules]
+    print(json.dumps(report, indent=2))
+    if args.budget is not None and report[0]['total_s'] > args.budget:
+        raise SystemExit(f"Importing {report[0]['module']} took {report[0]['total_s']:.2f} s, "
+                         f"over the budget of {args.budget} s")
@@ -0,0 +1,81 @@
+"""Benchmark of the PDF rasterizer backends
+
+Renders synthetic PDFs at the tiling resolution with each installed
+rasterizer and reports the time per page as JSON. Rasterizers that are
+not installed or fail to render are listed as unavailable:
+
+    python benchmarks/rasterize.py --pages 1 20 --page-sizes a4 a5
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from hki_sig_ml.rasterize import RASTERIZERS, get_rasterizer
+
+from classify import PAGE_SIZES, percentiles, synthetic_pdf
+
+
+def run_case(rasterizer, pdf_bytes:bytes, num_pages:int, dpi:int, window:int, repeat:int):
+    durations = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        rasterizer.page_count(pdf_bytes)
+        for first_page in range(1, num_pages+1, window):
+            rasterizer.render(pdf_bytes, dpi, first_page, min(first_page+window-1, num_pages))
+        durations.append(time.perf_counter() - t0)
+    return {'latency_s': percentiles(durations),
+            'pages_per_s': num_pages/np.mean(durations)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rasterizers', nargs='+', default=list(RASTERIZERS),
+                        choices=list(RASTERIZERS))
+    parser.add_argument('--pages', nargs='+', type=int, default=[1, 20])
+    parser.add_argument('--page-sizes', nargs='+', default=['a4', 'a5'], choices=list(PAGE_SIZES))
+    parser.add_argument('--scan-dpi', type=int, default=150,
+                        help='Resolution of the synthetic scanned pages')
+    parser.add_argument('--dpi', type=int, default=50, help='Rendering resolution')
+    parser.add_argument('--window', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None, help='Write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    # A rasterizer can import but fail to render, e.g. pdf2image without
+    # pdftoppm, so each one is probed with a one-page render
+    rasterizers, unavailable = [], {}
+    probe = synthetic_pdf(1, args.page_sizes[0], args.scan_dpi)
+    for name in args.rasterizers:
+        try:
+            rasterizer = get_rasterizer(name)
+            rasterizer.page_count(probe)
+            rasterizer.render(probe, args.dpi, 1, 1)
+        except Exception as e:
+            print(f'Skipping {name}: {type(e).__name__}: {e}', file=sys.stderr)
+            unavailable[name] = f'{type(e).__name__}: {e}'
+            continue
+        rasterizers.append(rasterizer)
+
+    cases = []
+    for num_pages, page_size in itertools.product(args.pages, args.page_sizes):
+        pdf_bytes = synthetic_pdf(num_pages, page_size, args.scan_dpi)
+        for rasterizer in rasterizers:
+            cases.append({'rasterizer': rasterizer.name,
+                          'pages': num_pages,
+                          'page_size': page_size,
+                          'dpi': args.dpi,
+                          **run_case(rasterizer, pdf_bytes, num_pages, args.dpi,
+                                     args.window, args.repeat)})
+
+    output = json.dumps({'cpu_count': os.cpu_count(), 'unavailable': unavailable,
+                         'cases': cases}, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
@@ -0,0 +1,47 @@
+# Production server configuration
+#
+#   gunicorn -c gunicorn.conf.py wsgi:app
+import gc
+
+# The preloaded app loads and warms up the model in the master. A forked
+# worker deadlocks in the OpenMP pool if the master's torch ran
+# multi-threaded, so the master stays single-threaded and the workers
+# set their own thread count in post_fork.
+try:
+    import torch
+    torch.set_num_threads(1)
+except ImportError:
+    pass
+
+from hki_signature_detection_api import config
+
+bind = '0.0.0.0:5000'
+workers = config.WORKERS
+threads = config.WORKER_THREADS
+worker_class = 'gthread'
+timeout = 600
+preload_app = True
+
+if config.WORKERS > 1 and config.JOB_QUEUE_URL is None:
+    raise SystemExit('HKI_WORKERS > 1 needs HKI_JOB_QUEUE_URL: /jobs uses an '
+                     'in-process queue, so job status would only be visible '
+                     'from the worker that accepted the job.')
+
+
+def pre_fork(server, worker):
+    # Keep the preloaded model's objects out of the garbage collector's
+    # reach, so that collections in the workers do not touch (and copy)
+    # the shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Split the cores between the workers instead of every worker
+    # starting a thread per core
+    try:
+        import torch
+        torch.set_num_threads(config.TORCH_THREADS)
+    except ImportError:
+        pass
+    from wsgi import server as api_server
+    api_server.start_background()
@@ -0,0 +1,77 @@
+"""Inference backends for exported models
+
+The backends run the TorchScript and ONNX artifacts written by
+hki_sig_ml.export without importing fastai. They can be passed to
+inference.classify and inference.predict in place of a fastai Learner.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+BACKENDS = ['fastai', 'torchscript', 'onnx']
+
+
+def read_metadata(artifact:Path):
+    # Vocabulary and preprocessing details stored next to an artifact
+    with open(Path(artifact).with_suffix('.json')) as f:
+        return json.load(f)
+
+
+def _labels_and_confidences(probs:np.ndarray, vocab:list):
+    indices = probs.argmax(axis=-1)
+    confidences = probs[np.arange(len(probs)), indices]
+    return [vocab[i] for i in indices], confidences.astype(float).tolist()
+
+
+class TorchScriptBackend:
+    """Run a TorchScript artifact with torch.jit"""
+
+    def __init__(self, artifact:Path):
+        import torch
+
+        self.artifact = Path(artifact)
+        self.vocab = read_metadata(self.artifact)['vocab']
+        self.model = torch.jit.load(str(self.artifact), map_location='cpu')
+        self.model.eval()
+
+    def predict_batch(self, arrays:np.ndarray):
+        import torch
+
+        with torch.no_grad():
+            probs = self.model(torch.from_numpy(np.ascontiguousarray(arrays)))
+        return _labels_and_confidences(probs.numpy(), self.vocab)
+
+
+class OnnxBackend:
+    """Run an ONNX artifact with ONNX Runtime on CPU"""
+
+    def __init__(self, artifact:Path, num_threads:int=None):
+        import onnxruntime
+
+        self.artifact = Path(artifact)
+        self.vocab = read_metadata(self.artifact)['vocab']
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(str(self.artifact), options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict_batch(self, arrays:np.ndarray):
+        probs, = self.session.run(None, {self.input_name: np.ascontiguousarray(arrays)})
+        return _labels_and_confidences(probs, self.vocab)
+
+
+def load_model(checkpoint:str, model:str='resnet34', path='.', backend:str='fastai'):
+    # Load a checkpoint for inference with the given backend. The
+    # exported backends look for the artifacts written by
+    # hki_sig_ml.export in path.
+    if backend == 'fastai':
+        from .inference import create_inference_model
+        return create_inference_model(checkpoint, model=model, path=path)
+    elif backend == 'torchscript':
+        return TorchScriptBackend(Path(path)/f'{checkpoint}.torchscript.pt')
+    elif backend == 'onnx':
+        return OnnxBackend(Path(path)/f'{checkpoint}.onnx')
+    raise ValueError(f'Unknown backend {backend}, expected one of {BACKENDS}')
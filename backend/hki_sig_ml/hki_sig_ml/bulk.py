@@ -0,0 +1,238 @@
+"""Offline classification of directories of PDF documents
+
+Walks a directory for PDF files and classifies them, writing the
+document results and page details in shards of --shard-size documents:
+
+    python -m hki_sig_ml.bulk /data/archive --output /data/audit \
+        --checkpoint resnet34_data_aug_sigscale_best --path /app --workers 4
+
+Documents are named by their path relative to the input directory.
+Pages are rasterized on --workers processes while the model scores the
+tiles of earlier pages. Every written shard is recorded in
+<output>/manifest.jsonl, and a run with the same output directory skips
+the documents in the manifest, so an interrupted run resumes where it
+left off and redoes at most one shard.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import sys
+import time
+
+import pandas as pd
+
+from .backends import BACKENDS, load_model
+from .inference import classify, iter_batches
+
+FORMATS = ['csv', 'parquet']
+
+
+def find_documents(directory):
+    # Paths of the PDF files under directory relative to it, sorted
+    directory = Path(directory)
+    return sorted(str(path.relative_to(directory)) for path in directory.rglob('*')
+                  if path.suffix.lower() == '.pdf' and path.is_file())
+
+
+class Manifest:
+    """Append-only record of the shards in an output directory and the
+    status of each document in them"""
+
+    def __init__(self, output):
+        self.output = Path(output)
+        self.path = self.output/'manifest.jsonl'
+        self.entries = []
+        if self.path.exists():
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+            for line in lines:
+                try:
+                    self.entries.append(json.loads(line))
+                except ValueError:
+                    pass
+            # Drop a line torn by an interrupted write so that the next
+            # entry does not get appended to it
+            if len(self.entries) < len([line for line in lines if line.strip()]):
+                tmp = self.path.with_suffix('.tmp')
+                with open(tmp, 'w') as f:
+                    f.writelines(json.dumps(entry) + '\n' for entry in self.entries)
+                os.replace(tmp, self.path)
+
+    def documents(self):
+        # Status of every document, later shards taking precedence
+        return {document: status for entry in self.entries
+                for document, status in entry['documents'].items()}
+
+    def next_shard(self):
+        return f'shard-{len(self.entries):05d}'
+
+    def remove_orphans(self):
+        # Remove shard files of shards that were not recorded before an
+        # interruption
+        shards = {entry['shard'] for entry in self.entries}
+        for path in self.output.glob('shard-*'):
+            if path.name.split('.')[0] not in shards:
+                path.unlink()
+
+    def add(self, shard:str, documents:dict, pages:int):
+        entry = {'shard': shard, 'documents': documents, 'pages': pages,
+                 'written': time.time()}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries.append(entry)
+
+
+def write_frame(df:pd.DataFrame, path:Path, format:str='csv'):
+    # Write atomically, so that a shard file is either complete or absent
+    tmp = path.with_name(path.name + '.tmp')
+    if format == 'parquet':
+        df.to_parquet(tmp, index=False)
+    else:
+        df.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def read_documents(directory, documents:list):
+    # Read the given documents, returning the readable ones in classify
+    # input format and results rows for the rest
+    pdf_documents, errors = [], []
+    for document in documents:
+        try:
+            with open(Path(directory)/document, 'rb') as f:
+                pdf_documents.append({'filename': document, 'bytes': f.read()})
+        except OSError as e:
+            errors.append({'document': document, 'status': 'ERROR', 'message': str(e),
+                           'num_pages': -1, 'positive': []})
+    return pdf_documents, errors
+
+
+class Progress:
+    """Documents and pages per second and the estimated time left"""
+
+    def __init__(self, total:int):
+        self.total = total
+        self.documents = 0
+        self.pages = 0
+        self.t0 = time.perf_counter()
+
+    def update(self, documents:int, pages:int):
+        self.documents += documents
+        self.pages += pages
+
+    def __str__(self):
+        elapsed = time.perf_counter() - self.t0
+        rate = self.documents/elapsed if elapsed > 0 else 0.
+        eta = '-'
+        if rate > 0:
+            eta = str(datetime.timedelta(seconds=int((self.total - self.documents)/rate)))
+        return (f'{self.documents}/{self.total} documents, {rate:.2f} documents/s, '
+                f'{self.pages/elapsed:.1f} pages/s, ETA {eta}')
+
+
+def run(directory, output, learner, format:str='csv', shard_size:int=500,
+        chunk_size:int=16, retry_errors:bool=False, **kwargs):
+    # Classify the PDF documents under directory that are not yet in the
+    # output manifest. Extra keyword arguments are passed on to classify.
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    manifest = Manifest(output)
+    manifest.remove_orphans()
+
+    done = manifest.documents()
+    if retry_errors:
+        done = {document: status for document, status in done.items() if status == 'OK'}
+    documents = find_documents(directory)
+    todo = [document for document in documents if document not in done]
+    print(f'{len(documents)} documents, {len(documents) - len(todo)} already done',
+          file=sys.stderr)
+
+    progress = Progress(len(todo))
+    results, details = [], []
+
+    def flush():
+        if not results:
+            return
+        shard = manifest.next_shard()
+        shard_results = pd.concat(results, ignore_index=True)
+        write_frame(shard_results, output/f'{shard}.results.{format}', format)
+        write_frame(pd.concat(details, ignore_index=True),
+                    output/f'{shard}.details.{format}', format)
+        manifest.add(shard, dict(zip(shard_results.document, shard_results.status)),
+                     int(shard_results.num_pages.clip(lower=0).sum()))
+        results.clear()
+        details.clear()
+
+    for chunk in iter_batches(todo, chunk_size):
+        pdf_documents, errors = read_documents(directory, chunk)
+        chunk_results, chunk_details = classify(pdf_documents, learner, **kwargs)
+        if errors:
+            chunk_results = pd.concat([chunk_results, pd.DataFrame(errors)],
+                                      ignore_index=True)
+        results.append(chunk_results)
+        details.append(chunk_details)
+        progress.update(len(chunk), int(chunk_results.num_pages.clip(lower=0).sum()))
+        print(progress, file=sys.stderr)
+        if sum(len(r) for r in results) >= shard_size:
+            flush()
+    flush()
+    return progress
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory', help='Directory searched recursively for PDF files')
+    parser.add_argument('--output', required=True, help='Directory for the shards and manifest')
+    parser.add_argument('--checkpoint', default='resnet34_data_aug_sigscale_best')
+    parser.add_argument('--model', default='resnet34', choices=['resnet18', 'resnet34', 'mobilenet_v2'])
+    parser.add_argument('--path', default='.')
+    parser.add_argument('--backend', default='fastai', choices=BACKENDS)
+    parser.add_argument('--format', default='csv', choices=FORMATS,
+                        help='Shard format, parquet needs pyarrow or fastparquet')
+    parser.add_argument('--shard-size', type=int, default=500, help='Documents per shard')
+    parser.add_argument('--chunk-size', type=int, default=16,
+                        help='Documents read into memory and classified at a time')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Rasterization processes, 0 rasterizes in the main process')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--window', type=int, default=8)
+    parser.add_argument('--dpi', type=int, default=50)
+    parser.add_argument('--rasterizer', default='auto')
+    parser.add_argument('--prefilter', action='store_true', help='Skip blank tiles')
+    parser.add_argument('--early-exit-threshold', type=float, default=None)
+    parser.add_argument('--retry-errors', action='store_true',
+                        help='Classify documents that failed in earlier runs again')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        import torch
+        torch.set_num_threads(args.threads)
+
+    learner = load_model(args.checkpoint, model=args.model, path=args.path,
+                         backend=args.backend)
+    prefilter = None
+    if args.prefilter:
+        from .prefilter import BlankTileFilter
+        prefilter = BlankTileFilter()
+
+    executor = None
+    if args.workers > 0:
+        executor = ProcessPoolExecutor(args.workers,
+                                       mp_context=multiprocessing.get_context('spawn'))
+    try:
+        progress = run(args.directory, args.output, learner, format=args.format,
+                       shard_size=args.shard_size, chunk_size=args.chunk_size,
+                       retry_errors=args.retry_errors, batch_size=args.batch_size,
+                       window=args.window, dpi=args.dpi, rasterizer=args.rasterizer,
+                       executor=executor, max_pending=2*args.workers, prefilter=prefilter,
+                       early_exit_threshold=args.early_exit_threshold)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print('Done:', progress, file=sys.stderr)
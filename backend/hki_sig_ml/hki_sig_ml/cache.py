@@ -0,0 +1,162 @@
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from .inference import classify, missing_to_none
+
+
+def document_key(pdf_bytes:bytes, checkpoint:str, model:str, dpi:int,
+                 variant:str=''):
+    # Content address of a document's analysis: the same PDF analysed
+    # with the same model and tiling resolution gives the same results.
+    # variant distinguishes pipeline options that change the results.
+    digest = hashlib.sha256(pdf_bytes)
+    digest.update(f'\0{checkpoint}\0{model}\0{dpi}\0{variant}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _to_native(o):
+    # JSON fallback for numpy scalars coming out of DataFrames
+    if hasattr(o, 'item'):
+        return o.item()
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+class ResultCache:
+    """Two-tier cache of per-document analysis results
+
+    Entries are kept in an in-process LRU of at most max_entries entries
+    and, if path is given, in an SQLite database shared between
+    processes. Entries older than max_age seconds are dropped from both
+    tiers and the database is trimmed to max_bytes by evicting the
+    least recently used entries."""
+
+    def __init__(self, max_entries:int=256, path:str=None,
+                 max_bytes:int=None, max_age:float=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if self.path is not None:
+            with self._connect() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS results '
+                             '(key TEXT PRIMARY KEY, value TEXT, size INTEGER, '
+                             'created REAL, accessed REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _expired(self, created:float, now:float):
+        return self.max_age is not None and now - created > self.max_age
+
+    def get(self, key:str):
+        # Return the cached entry for key, or None on a miss
+        now = time.time()
+        with self._lock:
+            if key in self._memory:
+                created, value = self._memory[key]
+                if not self._expired(created, now):
+                    self._memory.move_to_end(key)
+                    return json.loads(value)
+                del self._memory[key]
+
+        if self.path is None:
+            return None
+        with self._connect() as conn:
+            row = conn.execute('SELECT value, created FROM results WHERE key = ?',
+                               (key,)).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self._expired(created, now):
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                return None
+            conn.execute('UPDATE results SET accessed = ? WHERE key = ?',
+                         (now, key))
+        self._put_memory(key, created, value)
+        return json.loads(value)
+
+    def put(self, key:str, entry:dict):
+        now = time.time()
+        value = json.dumps(entry, default=_to_native)
+        self._put_memory(key, now, value)
+        if self.path is None:
+            return
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                         (key, value, len(value), now, now))
+            self._evict(conn, now)
+
+    def _put_memory(self, key:str, created:float, value:str):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._memory[key] = (created, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _evict(self, conn, now:float):
+        if self.max_age is not None:
+            conn.execute('DELETE FROM results WHERE created < ?',
+                         (now - self.max_age,))
+        if self.max_bytes is not None:
+            total, = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()
+            if total <= self.max_bytes:
+                return
+            rows = conn.execute('SELECT key, size FROM results ORDER BY accessed').fetchall()
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                total -= size
+
+
+def classify_cached(pdf_documents:list, learner, cache:ResultCache,
+                    checkpoint:str, model:str, dpi:int=50, variant:str='',
+                    **kwargs):
+    # Classify documents, reusing cached results for documents that
+    # have been analysed before. The results frame gets a cache column
+    # with 'hit' or 'miss' for each document. Failed documents are not
+    # cached. Extra keyword arguments are passed on to classify.
+    keys = [document_key(pdf['bytes'], checkpoint, model, dpi, variant)
+            for pdf in pdf_documents]
+    entries = [cache.get(key) for key in keys]
+
+    misses = [pdf for pdf, entry in zip(pdf_documents, entries) if entry is None]
+    if misses:
+        results, details = classify(misses, learner, dpi=dpi, **kwargs)
+        results = {row['document']: row
+                   for row in results.to_dict(orient='records')}
+        details = details.to_dict(orient='records')
+
+    res = []
+    res_details = []
+    for pdf, key, entry in zip(pdf_documents, keys, entries):
+        status = 'hit'
+        if entry is None:
+            status = 'miss'
+            if pdf['filename'] not in results:
+                continue
+            result = dict(results[pdf['filename']])
+            del result['document']
+            page_details = [{k: v for k, v in row.items() if k != 'document'}
+                            for row in details
+                            if row['document'] == pdf['filename']]
+            entry = {'result': result, 'details': page_details}
+            if result['status'] == 'OK':
+                cache.put(key, entry)
+
+        res.append({'document': pdf['filename'], **entry['result'],
+                    'cache': status})
+        res_details.extend({'document': pdf['filename'], **row}
+                           for row in entry['details'])
+
+    return pd.DataFrame(res), missing_to_none(pd.DataFrame(res_details))
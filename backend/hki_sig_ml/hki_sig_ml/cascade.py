@@ -0,0 +1,46 @@
+"""Whole page screening ahead of the tiled analysis
+
+A PageScreener scores a thumbnail of each rasterized page with a cheap
+page level model, for example a mobilenet_v2 trained on whole pages
+squished to 414x585. Pages that it labels as having no signature with
+at least threshold confidence skip the tiled analysis, the rest are
+tiled and scored with the tile model as usual. The screening model is
+loaded like the tile model, with hki_sig_ml.backends.load_model, and
+needs the same 'False' / 'True' vocab.
+"""
+import numpy as np
+from PIL import Image
+
+from .inference import iter_batches, predict_batch
+from .metrics import stage
+
+
+class PageScreener:
+    def __init__(self, learner, threshold:float=0.9, size:tuple=(414, 585),
+                 batch_size:int=16):
+        # size is the (width, height) of the thumbnails the model was
+        # trained on
+        self.learner = learner
+        self.threshold = threshold
+        self.size = tuple(size)
+        self.batch_size = batch_size
+
+    def thumbnail(self, pixels:np.ndarray):
+        return np.asarray(Image.fromarray(pixels).resize(self.size, Image.BILINEAR))
+
+    def skips(self, label:str, confidence:float):
+        # Whether a page with the given screening result skips the tiled
+        # analysis
+        return label == 'False' and confidence >= self.threshold
+
+    def screen(self, pages):
+        # Score a stream of (document, page number, pixels), yielding
+        # (document, page number, pixels, label, confidence). Pages are
+        # scored batch_size at a time.
+        for batch in iter_batches(pages, self.batch_size):
+            with stage('preprocess'):
+                thumbnails = np.stack([self.thumbnail(pixels) for _, _, pixels in batch])
+            labels, confidences = predict_batch(thumbnails, self.learner)
+            for (pdf, page_number, pixels), label, confidence in zip(batch, labels,
+                                                                     confidences):
+                yield pdf, page_number, pixels, label, confidence
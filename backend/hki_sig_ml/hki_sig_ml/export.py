@@ -0,0 +1,132 @@
+"""Export a checkpoint to TorchScript and ONNX artifacts
+
+The artifacts take a batch of HxWx3 uint8 tiles and return class
+probabilities, with the scaling and normalization of the fastai pipeline
+baked in. A JSON file with the vocabulary is written next to them.
+
+    python -m hki_sig_ml.export resnet34_data_aug_sigscale_best --model resnet34 --path /app
+"""
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+
+import torch
+from torch import nn
+
+from .backends import OnnxBackend, TorchScriptBackend
+from .inference import create_inference_model, predict_batch
+
+
+class TileClassifier(nn.Module):
+    """Wrap a model with tile preprocessing and a softmax"""
+
+    def __init__(self, model:nn.Module, mean:torch.Tensor=None, std:torch.Tensor=None):
+        super().__init__()
+        self.model = model
+        self.register_buffer('mean', torch.zeros(1, 3, 1, 1) if mean is None else mean)
+        self.register_buffer('std', torch.ones(1, 3, 1, 1) if std is None else std)
+
+    def forward(self, tiles:torch.Tensor):
+        x = tiles.permute(0, 3, 1, 2).float()/255.
+        x = (x - self.mean)/self.std
+        return torch.softmax(self.model(x), dim=-1)
+
+
+def create_tile_classifier(learner):
+    # Bake the learner's after_batch normalization (if any) into the model
+    from fastai.data.transforms import Normalize
+
+    mean = std = None
+    for tfm in learner.dls.after_batch.fs:
+        if isinstance(tfm, Normalize):
+            mean = tfm.mean.detach().cpu().view(1, 3, 1, 1).float()
+            std = tfm.std.detach().cpu().view(1, 3, 1, 1).float()
+    return TileClassifier(learner.model.cpu(), mean, std).eval()
+
+
+def save_torchscript(classifier:nn.Module, artifact:Path, metadata:dict,
+                     tile_size:int=415):
+    # Trace the classifier and write it with its metadata file
+    example = torch.zeros(2, tile_size, tile_size, 3, dtype=torch.uint8)
+    with torch.no_grad():
+        torch.jit.trace(classifier, example).save(str(artifact))
+    write_metadata(artifact, metadata)
+
+
+def write_metadata(artifact:Path, metadata:dict):
+    with open(Path(artifact).with_suffix('.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+def get_metadata(learner, checkpoint:str, model:str, tile_size:int=415):
+    return {'checkpoint': checkpoint,
+            'model': model,
+            'tile_size': tile_size,
+            'vocab': [str(label) for label in learner.dls.vocab]}
+
+
+def export(checkpoint:str, model:str='resnet34', path='.', output=None,
+           tile_size:int=415, formats=('torchscript', 'onnx')):
+    # Write <checkpoint>.torchscript.pt, <checkpoint>.onnx and
+    # <checkpoint>.json to output and return the artifact paths
+    output = Path(path if output is None else output)
+    output.mkdir(parents=True, exist_ok=True)
+    learner = create_inference_model(checkpoint, model=model, path=path)
+    classifier = create_tile_classifier(learner)
+    metadata = get_metadata(learner, checkpoint, model, tile_size)
+    artifacts = []
+    if 'torchscript' in formats:
+        artifact = output/f'{checkpoint}.torchscript.pt'
+        save_torchscript(classifier, artifact, metadata, tile_size)
+        artifacts.append(artifact)
+    if 'onnx' in formats:
+        example = torch.zeros(2, tile_size, tile_size, 3, dtype=torch.uint8)
+        with torch.no_grad():
+            artifact = output/f'{checkpoint}.onnx'
+            torch.onnx.export(classifier, example, str(artifact),
+                              input_names=['tiles'], output_names=['probs'],
+                              dynamic_axes={'tiles': {0: 'batch'}, 'probs': {0: 'batch'}},
+                              opset_version=11)
+        write_metadata(artifact, metadata)
+        artifacts.append(artifact)
+
+    return learner, artifacts
+
+
+def compare(learner, artifacts:list, num_tiles:int=16, tile_size:int=415, seed:int=0):
+    # Largest confidence difference and number of label disagreements
+    # between the fastai path and each exported artifact on random tiles
+    rng = np.random.default_rng(seed)
+    tiles = rng.integers(0, 256, (num_tiles, tile_size, tile_size, 3), dtype=np.uint8)
+    labels, confidences = predict_batch(tiles, learner)
+    report = {}
+    for artifact in artifacts:
+        backend = (OnnxBackend if artifact.suffix == '.onnx' else TorchScriptBackend)(artifact)
+        artifact_labels, artifact_confidences = backend.predict_batch(tiles)
+        report[artifact.name] = {
+            'max_confidence_difference': float(np.max(np.abs(np.array(confidences) - artifact_confidences))),
+            'label_mismatches': int(sum(a != b for a, b in zip(labels, artifact_labels)))}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('checkpoint', help='Checkpoint name, loaded from <path>/models/<checkpoint>.pth')
+    parser.add_argument('--model', default='resnet34', choices=['resnet18', 'resnet34', 'mobilenet_v2'])
+    parser.add_argument('--path', default='.')
+    parser.add_argument('--output', default=None, help='Output directory, defaults to --path')
+    parser.add_argument('--format', action='append', choices=['torchscript', 'onnx'],
+                        help='Artifact format, may be repeated (default: both)')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='Maximum allowed confidence difference to the fastai model')
+    args = parser.parse_args()
+
+    learner, artifacts = export(args.checkpoint, args.model, args.path, args.output,
+                                formats=args.format or ('torchscript', 'onnx'))
+    report = compare(learner, artifacts)
+    print(json.dumps(report, indent=2))
+    if any(r['max_confidence_difference'] > args.tolerance or r['label_mismatches']
+           for r in report.values()):
+        raise SystemExit('Exported model does not match the fastai model')
@@ -1,51 +1,185 @@
+from __future__ import annotations
+
+import collections
+from concurrent.futures import Executor
+import itertools
+import os
 from pathlib import Path
+import tempfile
+from typing import TYPE_CHECKING
 
 import numpy as np
 
-from fastai.data.block import DataBlock, CategoryBlock
-from fastai.data.transforms import ItemGetter
-from fastai.learner import Learner
-from fastai.vision.data import ImageBlock
-from fastai.vision.learner import cnn_learner
-from fastai.vision.core import PILImage
-
 import pandas as pd
 
-import PIL
+# fastai and torch are imported where they are needed, so that the
+# tiling and aggregation pipeline can run with an exported model from
+# hki_sig_ml.backends without them
+if TYPE_CHECKING:
+    from fastai.learner import Learner
+    from torch import nn
 
-import pdf2image
+from .metrics import count, stage
+from .rasterize import (get_page_count, get_page_pixels, get_page_ranges,
+                        get_tile_size, iter_pages, iter_page_tiles,
+                        rasterize_pages)
 
-from torch import nn
-from torchvision.models import resnet18, resnet34, mobilenet_v2
+def _tile_info(pdf:dict, page_number:int, k:int, tile:list):
+    return {'document': pdf['filename'], 
+            'page': page_number, 
+            'tile': k, 
+            'tile_extent': tile}
 
-from .utils import expand_image, get_tiles
 
-def split_documents(pdf_documents:list, dpi:int=50):
-    # Split each page into square tiles with side length equal to
-    # A4 width
-    a4_width = 8.3
-    dpi = 50
-    tile_size = int(a4_width*dpi)
-    info = []
-    tiles = []
-    errors = []
-    
-    for i, pdf in enumerate(pdf_documents):
+def _iter_pages_serial(pdf_documents:list, dpi:int, window:int, errors:list,
+                       rasterizer:str):
+    tile_size = get_tile_size(dpi)
+    for pdf in pdf_documents:
+        try:
+            for page_number, page in iter_pages(pdf['bytes'], dpi, window,
+                                                rasterizer=rasterizer):
+                with stage('tiling'):
+                    pixels = get_page_pixels(page, tile_size)
+                    del page
+                yield pdf, page_number, pixels
+        except Exception as e:
+            errors.append({'document': pdf['filename'], 'error': e})
+            print('Unable to open', pdf['filename'], 'because', e)
+
+
+def _iter_pages_parallel(pdf_documents:list, dpi:int, window:int, errors:list,
+                         rasterizer:str, executor:Executor, max_pending:int):
+    # Fan out rasterization of (document, page range) chunks to the
+    # executor. Chunks are collected in submission order so the page
+    # order matches the serial path, and at most max_pending chunks are
+    # in flight at a time. Each document is written to a temporary file
+    # once and the workers open it by path, instead of every chunk
+    # sending the whole document to a worker.
+    remaining = {}
+    def submit(directory):
+        for i, pdf in enumerate(pdf_documents):
+            try:
+                with stage('decode'):
+                    num_pages = get_page_count(pdf['bytes'], rasterizer)
+            except Exception as e:
+                yield pdf, None, e
+                continue
+            ranges = get_page_ranges(num_pages, window)
+            if not ranges:
+                continue
+            path = os.path.join(directory, f'{i}.pdf')
+            with open(path, 'wb') as f:
+                f.write(pdf['bytes'])
+            remaining[path] = len(ranges)
+            for first_page, last_page in ranges:
+                yield pdf, path, executor.submit(rasterize_pages, path, dpi,
+                                                 first_page, last_page, rasterizer)
+
+    failed = set()
+    def collect(pdf, chunk):
+        # Unreadable documents have a single exception entry, otherwise
+        # the rest of a document is skipped after its first failed chunk
+        if id(pdf) in failed:
+            chunk.cancel()
+            return []
         try:
-            pages = pdf2image.convert_from_bytes(pdf['bytes'], dpi=dpi)
-            for j, page in enumerate(pages):
-                page = expand_image(page, tile_size, tile_size)
-                for k, tile in enumerate(get_tiles(page, tile_size)):
-                    tile = [tile['x_start'], tile['y_start'], 
-                            tile['x_stop'], tile['y_stop']]
-                    info.append({'document': pdf['filename'], 
-                                 'page': j+1, 
-                                 'tile': k+1, 
-                                 'tile_extent': tile})
-                    tiles.append(PILImage.create(np.array(page.crop(tile))))
+            if isinstance(chunk, Exception):
+                raise chunk
+            # Time blocked on the pool is the rasterization cost as seen
+            # by the request
+            with stage('rasterize'):
+                return chunk.result()
         except Exception as e:
+            failed.add(id(pdf))
             errors.append({'document': pdf['filename'], 'error': e})
             print('Unable to open', pdf['filename'], 'because', e)
+            return []
+
+    def pages(pdf, path, chunk):
+        chunk_pages = collect(pdf, chunk)
+        if path is not None:
+            # Remove a document's file once its last chunk is done
+            remaining[path] -= 1
+            if not remaining[path]:
+                os.remove(path)
+        for page_number, pixels in chunk_pages:
+            yield pdf, page_number, pixels
+
+    with tempfile.TemporaryDirectory(prefix='hki-rasterize-') as directory:
+        pending = collections.deque()
+        try:
+            for item in submit(directory):
+                pending.append(item)
+                while len(pending) >= max_pending:
+                    yield from pages(*pending.popleft())
+            while pending:
+                yield from pages(*pending.popleft())
+        finally:
+            # Let chunks still running finish before their files are
+            # removed, if the caller stops early
+            for _, _, chunk in pending:
+                if not isinstance(chunk, Exception) and not chunk.cancel():
+                    try:
+                        chunk.result()
+                    except Exception:
+                        pass
+
+
+def iter_document_pages(pdf_documents:list, dpi:int=50, window:int=8,
+                        errors:list=None, executor:Executor=None,
+                        max_pending:int=None, rasterizer:str='auto'):
+    # Yield (document, page number, pixels) in (document, page) order as
+    # pages are rasterized, padded to at least one tile. Documents that
+    # cannot be read are appended to errors. If an executor is given,
+    # page ranges of window pages are rasterized in parallel on it, with
+    # up to max_pending ranges in flight (twice the executor's workers
+    # keeps them all busy). rasterizer names the backend from
+    # hki_sig_ml.rasterize.RASTERIZERS, or 'auto'.
+    if errors is None:
+        errors = []
+    if executor is None:
+        return _iter_pages_serial(pdf_documents, dpi, window, errors, rasterizer)
+    if max_pending is None:
+        raise ValueError('max_pending is needed with an executor')
+    return _iter_pages_parallel(pdf_documents, dpi, window, errors, rasterizer,
+                                executor, max_pending)
+
+
+def tile_pages(pages, dpi:int=50):
+    # Split each page of a (document, page number, pixels) stream into
+    # square tiles with side length equal to A4 width, yielding
+    # (tile info, tile) pairs
+    tile_size = get_tile_size(dpi)
+    for pdf, page_number, pixels in pages:
+        with stage('tiling'):
+            tiles = list(iter_page_tiles(pixels, tile_size))
+        del pixels
+        for k, tile, tile_pixels in tiles:
+            yield _tile_info(pdf, page_number, k, tile), tile_pixels
+
+
+def iter_tiles(pdf_documents:list, dpi:int=50, window:int=8, errors:list=None,
+               executor:Executor=None, max_pending:int=None, rasterizer:str='auto'):
+    # Yield (tile info, tile) pairs in (document, page, tile) order as
+    # they are produced, see iter_document_pages
+    return tile_pages(iter_document_pages(pdf_documents, dpi, window, errors,
+                                          executor, max_pending, rasterizer),
+                      dpi)
+
+
+def split_documents(pdf_documents:list, dpi:int=50, window:int=8,
+                    executor:Executor=None, max_pending:int=None,
+                    rasterizer:str='auto'):
+    # Split all documents into tiles at once
+    from fastai.vision.core import PILImage
+
+    info = []
+    tiles = []
+    errors = []
+    for tile_info, tile in iter_tiles(pdf_documents, dpi, window, errors,
+                                      executor, max_pending, rasterizer):
+        info.append(tile_info)
+        tiles.append(PILImage.create(tile))
             
     return tiles, pd.DataFrame(info), pd.DataFrame(errors)
 
@@ -54,6 +188,13 @@ def _mobilenetv2_split(m:nn.Module): return (m[0][0][10],m[1])
 
 
 def create_inference_model(checkpoint:str=None, model='resnet34', path='.'):
+    from fastai.data.block import DataBlock, CategoryBlock
+    from fastai.data.transforms import ItemGetter
+    from fastai.vision.data import ImageBlock
+    from fastai.vision.learner import cnn_learner
+    from fastai.vision.core import PILImage
+    from torchvision.models import resnet18, resnet34, mobilenet_v2
+
     if model == 'resnet34':
         model = resnet34
     elif model == 'resnet18':
@@ -85,8 +226,10 @@ def create_inference_model(checkpoint:str=None, model='resnet34', path='.'):
     return learner
 
 
-def predict(pdf_tiles:list, learner:Learner):
+def predict_per_tile(pdf_tiles:list, learner:Learner):
     # Get predicted labels and confidences for the given image tiles
+    # one tile at a time through the fastai item pipeline. Kept as a
+    # reference for validating the batched path.
     predictions = [learner.predict(tile) for tile in pdf_tiles]
     labels = [prediction[0] for prediction in predictions]
     confidences = [float(prediction[2][prediction[1]].numpy()) 
@@ -94,89 +237,306 @@ def predict(pdf_tiles:list, learner:Learner):
     return labels, confidences
 
 
+def iter_batches(items, batch_size:int):
+    # Group an iterable into lists of at most batch_size items
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _predict_batch_fastai(arrays, learner:Learner):
+    # The batch goes through the same after_batch transforms
+    # (IntToFloatTensor, Normalize if any) as learner.predict uses
+    import torch
+    from fastai.vision.core import TensorImage
+
+    learner.model.eval()
+    with stage('preprocess'):
+        x = torch.from_numpy(np.ascontiguousarray(arrays)).permute(0, 3, 1, 2)
+        x = learner.dls.after_batch(TensorImage(x.to(learner.dls.device)))
+    activation = getattr(learner.loss_func, 'activation', None)
+    with stage('inference'), torch.no_grad():
+        output = learner.model(x)
+        probs = activation(output) if activation is not None else torch.softmax(output, dim=-1)
+    confidences, indices = probs.max(dim=-1)
+    vocab = learner.dls.vocab
+    labels = [str(vocab[i]) for i in indices.cpu().numpy()]
+    return labels, confidences.cpu().numpy().astype(float).tolist()
+
+
+def predict_batch(arrays, learner:Learner):
+    # Run one forward pass over a stack of HxWx3 uint8 tiles. learner
+    # is either a fastai Learner or an inference backend from
+    # hki_sig_ml.backends.
+    if hasattr(learner, 'predict_batch'):
+        with stage('inference'):
+            return learner.predict_batch(arrays)
+    return _predict_batch_fastai(arrays, learner)
+
+
+def predict(pdf_tiles, learner:Learner, batch_size:int=64):
+    # Get predicted labels and confidences for the given image tiles,
+    # stacking them into batches of batch_size tiles per forward pass.
+    # pdf_tiles may be any iterable, it is consumed one batch at a time.
+    labels, confidences = [], []
+    for batch in iter_batches(pdf_tiles, batch_size):
+        with stage('preprocess'):
+            batch = np.stack([np.asarray(tile) for tile in batch])
+        batch_labels, batch_confidences = predict_batch(batch, learner)
+        labels.extend(batch_labels)
+        confidences.extend(batch_confidences)
+    return labels, confidences
+
+
 def distill_results(df: pd.DataFrame, errors: pd.DataFrame=None):
-    res = {}
-    for i,row in df.iterrows():
-        index = row.document
-        # If we haven't seen this page before, include it in the
-        # distilled results
-        if index not in res:
-            res[index] = {'document': row.document,
-                          'status': 'OK',
-                          'message': '',
-                          'num_pages': 1,
-                          'positive': [row.page] if row.label == 'True' else []}
-        else:
-            new_pages = res[index]['num_pages'] if row.page <= res[index]['num_pages'] else row.page
-            if row.label == 'True' and int(row.page):
-                new_positives = res[index]['positive'] + [int(row.page)]
-            else:
-                new_positives = res[index]['positive']
-            res[index] = {**res[index],
-                          'num_pages': int(new_pages),
-                          'positive': sorted(list(set(new_positives)))}
-            
-    if errors is not None:
-        for i,row in errors.iterrows():
-            res.append({'document': row.document, 
-                        'status': 'ERROR', 
-                        'message': '', 
-                        'num_pages': -1, 
-                        'positive': []})
-            
-    return pd.DataFrame(res.values())
+    # Aggregate predictions over pages: a document lists the pages with
+    # at least one signature tile. Documents that failed are reported
+    # as errors instead of with any partial results.
+    res = pd.DataFrame(columns=['document', 'status', 'message', 
+                                'num_pages', 'positive'])
+    failed = set() if errors is None or not len(errors) else set(errors.document)
+
+    if len(df):
+        df = df.loc[~df.document.isin(failed)]
+        num_pages = df.groupby('document', sort=False).page.max()
+        positive = (df.loc[df.label == 'True', ['document', 'page']]
+                      .drop_duplicates()
+                      .sort_values('page')
+                      .groupby('document', sort=False).page
+                      .apply(lambda pages: [int(page) for page in pages]))
+        res = pd.DataFrame({'document': num_pages.index,
+                            'status': 'OK',
+                            'message': '',
+                            'num_pages': num_pages.values.astype(int),
+                            'positive': [positive.get(document, []) 
+                                         for document in num_pages.index]})
+
+    if failed:
+        res = pd.concat([res, pd.DataFrame([{'document': document, 
+                                             'status': 'ERROR', 
+                                             'message': '', 
+                                             'num_pages': -1, 
+                                             'positive': []}
+                                            for document in errors.document.unique()])],
+                        ignore_index=True)
+
+    return res
 
 
 def distill_details(info: pd.DataFrame, errors: pd.DataFrame=None):
-    # Aggregate predictions over tiles
-    res = {}
-    for i,row in info.iterrows():
-        index = (row.document, row.page)
-        # If we haven't seen this page before, include it in the
-        # distilled results
-        if index not in res:
-            res[index] = {'document': row.document,
-                          'status': 'OK',
-                          'page': row.page,
-                          'label': row.label,
-                          'confidence': row.confidence}
-        # If we think we've found a signature, switch the page classification
-        if res[index]['label'] == 'False' and row.label == 'True':
-            res[index] = {**res[index],
-                          'label': row.label,
-                          'confidence': row.confidence}
-        # A no signature page confidence is the lowest confidence
-        # found
-        if res[index]['label'] == row.label == 'False' and res[index]['confidence'] > row.confidence:
-            res[index] = {**res[index],
-                          'confidence': row.confidence}
-        # A signature page confidence is the highest confidence
-        # found
-        if res[index]['label'] == row.label == 'True' and res[index]['confidence'] < row.confidence:
-            res[index] = {**res[index],
-                          'confidence': row.confidence}
-            
-    if errors is not None:
-        for i,row in errors.iterrows():
-            res[(row.document,)] = {'document': row.document, 
-                                    'status': 'ERROR'}
-            
-    df = pd.DataFrame(res.values())
-    df = df.fillna('-')
+    # Aggregate predictions over tiles. A page with a signature tile is
+    # labeled by its most confident signature tile, otherwise by its
+    # least confident no signature tile.
+    res = pd.DataFrame()
+    if len(info):
+        info = info.reset_index(drop=True)
+        pages = ['document', 'page']
+        index = info.groupby(pages, sort=False).confidence.idxmin()
+        positive = info.loc[info.label == 'True']
+        if len(positive):
+            best = positive.groupby(pages, sort=False).confidence.idxmax()
+            index.loc[best.index] = best
+        rows = info.loc[index.values]
+        res = pd.DataFrame({'document': rows.document.values,
+                            'status': 'OK',
+                            'page': rows.page.values,
+                            'label': rows.label.values,
+                            'confidence': rows.confidence.values})
 
-    return df
+    if errors is not None and len(errors):
+        res = pd.concat([res, pd.DataFrame({'document': errors.document.unique(),
+                                            'status': 'ERROR'})],
+                        ignore_index=True)
+        if 'page' in res:
+            # Keep the pages integers next to the missing ones
+            res['page'] = res.page.astype('Int64')
 
-def classify(pdf_documents: list, learner:Learner):
-    tiles, info, errors = split_documents(pdf_documents)
-    print('Got', len(tiles), 'tiles')
+    return missing_to_none(res)
 
-    labels, confidences = predict(tiles, learner)
 
-    info['label'] = labels
-    info['confidence'] = confidences
+def missing_to_none(df: pd.DataFrame):
+    # Missing values (the page and confidence of failed documents) as
+    # None, so that they are marshalled as null rather than failing as
+    # numbers
+    return df.astype(object).where(df.notna(), None)
 
-    results = distill_results(info, errors)
-    details = distill_details(info, errors)
+def _report_progress(pages, progress=None):
+    # Call progress(document, page) as each page of a (document, page
+    # number, pixels) stream has been consumed
+    if progress is None:
+        yield from pages
+        return
+    for page in pages:
+        yield page
+        progress(page[0]['filename'], page[1])
 
-    return results, details
 
+def _screen_pages(pages, screener, screened:dict, skipped:list):
+    # Pass on the pages of a (document, page number, pixels) stream that
+    # the screener does not rule out. The screening result of every page
+    # is recorded in screened, and each ruled out page gets a single
+    # tile-less row in skipped.
+    for pdf, page_number, pixels, label, confidence in screener.screen(pages):
+        screened[(pdf['filename'], page_number)] = (label, confidence)
+        if screener.skips(label, confidence):
+            skipped.append({**_tile_info(pdf, page_number, 0, None),
+                            'label': label, 'confidence': confidence})
+            continue
+        yield pdf, page_number, pixels
+
+
+def _classify_tiles(stream, score, prefilter=None):
+    # Score a stream of (tile info, tile) pairs, returning the tile
+    # infos, labels and confidences. Tiles the prefilter finds blank
+    # are labeled without scoring them.
+    info = []
+    blank = []
+
+    def tiles():
+        for tile_info, tile in stream:
+            info.append(tile_info)
+            if prefilter is not None and prefilter.is_blank(tile):
+                blank.append(True)
+                continue
+            blank.append(False)
+            yield tile
+
+    labels, confidences = score(tiles())
+
+    if prefilter is not None:
+        blank = np.array(blank, dtype=bool)
+        count('blank_tiles', int(blank.sum()))
+        all_labels = np.full(len(blank), 'False', dtype=object)
+        all_labels[~blank] = labels
+        all_confidences = np.full(len(blank), prefilter.confidence)
+        all_confidences[~blank] = confidences
+        labels, confidences = list(all_labels), list(all_confidences)
+
+    return info, labels, confidences
+
+
+def bottom_first(tile_info:dict):
+    # Signatures are usually at the bottom of the page, towards the right
+    x_start, y_start = tile_info['tile_extent'][:2]
+    return (-y_start, -x_start)
+
+
+def _iter_page_groups(stream, max_pages:int):
+    # Group a stream of (tile info, tile) pairs into lists of at most
+    # max_pages pages, each page a list of (tile info, tile) pairs
+    group = []
+    pages = itertools.groupby(stream, key=lambda item: (item[0]['document'], item[0]['page']))
+    for _, page in pages:
+        group.append(list(page))
+        if len(group) == max_pages:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+def _classify_tiles_early_exit(stream, score, threshold:float, prefilter=None,
+                               max_pages:int=64, tile_order=bottom_first):
+    # Score the tiles of each page in tile_order and stop once a tile is
+    # labeled 'True' with at least threshold confidence. Pages are
+    # scored in rounds, one tile per undecided page per round, so that
+    # the model still sees batches of up to max_pages tiles. Tiles that
+    # were never scored are left out of the results.
+    info, labels, confidences = [], [], []
+    for pages in _iter_page_groups(stream, max_pages):
+        pages = [sorted(page, key=lambda item: tile_order(item[0])) for page in pages]
+        undecided = list(range(len(pages)))
+        n = 0
+        while undecided:
+            round_info, round_labels, round_confidences = _classify_tiles(
+                iter([pages[i][n] for i in undecided]), score, prefilter)
+            info.extend(round_info)
+            labels.extend(round_labels)
+            confidences.extend(round_confidences)
+            undecided = [i for i, label, confidence
+                         in zip(undecided, round_labels, round_confidences)
+                         if n+1 < len(pages[i])
+                         and not (label == 'True' and confidence >= threshold)]
+            n += 1
+    return info, labels, confidences
+
+
+def classify(pdf_documents: list, learner:Learner, batch_size:int=64,
+             window:int=8, executor:Executor=None, max_pending:int=None,
+             progress=None, scheduler=None, prefilter=None, early_exit_threshold:float=None,
+             rasterizer:str='auto', dpi:int=50, screener=None,
+             whole_page:bool=False, heatmaps:dict=None):
+    # Tiles are streamed from rasterization straight into inference, so
+    # only a window of pages and a batch of tiles are in memory at once.
+    # progress(document, page) is called as each page has been tiled.
+    # If a shared BatchScheduler is given, tiles are batched together
+    # with other concurrent callers' tiles instead. If a
+    # BlankTileFilter is given, tiles it finds blank skip the model.
+    # With early_exit_threshold, a page's remaining tiles are skipped
+    # once one of them is a confident signature, so page confidences
+    # in the details are lower bounds. If a PageScreener is given,
+    # pages it rules out are not tiled, and the details get its
+    # screen_label and screen_confidence for every page. With
+    # whole_page, a fastai learner scores all tiles of a page from one
+    # backbone pass (see hki_sig_ml.wholepage), the scheduler,
+    # prefilter and early exit are not used, and page heatmaps are
+    # stored in heatmaps if given.
+    errors = []
+    screened = {}
+    skipped = []
+
+    def score(tiles):
+        if scheduler is not None:
+            return scheduler.predict(tiles)
+        return predict(tiles, learner, batch_size=batch_size)
+
+    pages = _report_progress(iter_document_pages(pdf_documents, dpi, window, errors,
+                                                 executor, max_pending, rasterizer),
+                             progress)
+    if screener is not None:
+        pages = _screen_pages(pages, screener, screened, skipped)
+    if whole_page:
+        from .wholepage import classify_pages
+        info, labels, confidences = classify_pages(pages, learner, dpi, heatmaps)
+    elif early_exit_threshold is None:
+        info, labels, confidences = _classify_tiles(tile_pages(pages, dpi), score, prefilter)
+    else:
+        info, labels, confidences = _classify_tiles_early_exit(
+            tile_pages(pages, dpi), score, early_exit_threshold, prefilter, max_pages=batch_size)
+    print('Got', len(info), 'tiles')
+    num_tiles = len(info)
+
+    with stage('aggregate'):
+        info = pd.DataFrame(info)
+        errors = pd.DataFrame(errors)
+        info['label'] = labels
+        info['confidence'] = confidences
+        if skipped:
+            # Put the screened out pages back in document and page order
+            order = {pdf['filename']: i for i, pdf in enumerate(pdf_documents)}
+            info = pd.concat([info, pd.DataFrame(skipped)], ignore_index=True)
+            info = (info.assign(order=info.document.map(order))
+                        .sort_values(['order', 'page', 'tile'], kind='mergesort')
+                        .drop(columns='order')
+                        .reset_index(drop=True))
+
+        results = distill_results(info, errors)
+        details = distill_details(info, errors)
+        if screener is not None:
+            screen = [screened.get(page, (None, None))
+                      for page in zip(details.document, details.page)]
+            details['screen_label'] = [label for label, _ in screen]
+            details['screen_confidence'] = [confidence for _, confidence in screen]
+
+    count('documents', len(pdf_documents))
+    count('tiles', num_tiles)
+    count('pages', len(details) - len(errors))
+    count('screened_pages', len(skipped))
+    count('errors', len(errors))
+
+    return results, details
@@ -0,0 +1,125 @@
+"""Pipeline stage timings and counters
+
+Code in the pipeline wraps its work in stage(name) and counts items
+with count(name). Stage durations are summed per request in the
+innermost active StageTimings of the current thread, and each request's
+per-stage totals are observed into the process-wide METRICS histograms
+when the StageTimings closes. METRICS renders in the Prometheus text
+exposition format.
+"""
+import collections
+from contextlib import contextmanager
+import threading
+import time
+
+STAGES = ['decode', 'rasterize', 'tiling', 'preprocess', 'inference',
+          'aggregate', 'serialize']
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10., 30., 60., 300.)
+
+COUNTERS = {'documents': 'Documents analysed',
+            'pages': 'Pages rasterized',
+            'tiles': 'Tiles produced',
+            'blank_tiles': 'Tiles skipped by the blank tile prefilter',
+            'screened_pages': 'Pages ruled out by the page screener without tiling',
+            'errors': 'Documents that could not be analysed'}
+
+
+class Histogram:
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value:float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, prefix:str='hki'):
+        self.prefix = prefix
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.counters = collections.Counter({name: 0 for name in COUNTERS})
+        self._lock = threading.Lock()
+
+    def observe(self, stage:str, seconds:float):
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    def inc(self, counter:str, amount:int=1):
+        with self._lock:
+            self.counters[counter] += amount
+
+    def render(self):
+        # Prometheus text exposition format
+        name = f'{self.prefix}_stage_duration_seconds'
+        lines = [f'# HELP {name} Time spent per request in each pipeline stage',
+                 f'# TYPE {name} histogram']
+        with self._lock:
+            for stage, histogram in self.stages.items():
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+            for counter, value in self.counters.items():
+                name = f'{self.prefix}_{counter}_total'
+                lines.append(f'# HELP {name} {COUNTERS.get(counter, counter)}')
+                lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+_local = threading.local()
+
+
+class StageTimings:
+    """Per-request stage durations, active on the current thread while
+    used as a context manager"""
+
+    def __init__(self, metrics:Metrics=METRICS):
+        self.metrics = metrics
+        self.durations = collections.OrderedDict()
+
+    def add(self, stage:str, seconds:float):
+        self.durations[stage] = self.durations.get(stage, 0.) + seconds
+
+    def __enter__(self):
+        if not hasattr(_local, 'timings'):
+            _local.timings = []
+        _local.timings.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _local.timings.remove(self)
+        if self.metrics is not None:
+            for stage, seconds in self.durations.items():
+                self.metrics.observe(stage, seconds)
+        return False
+
+
+@contextmanager
+def stage(name:str):
+    # Time the enclosed block as part of the given stage
+    timings = getattr(_local, 'timings', None)
+    if not timings:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[-1].add(name, time.perf_counter() - t0)
+
+
+def count(name:str, amount:int=1, metrics:Metrics=METRICS):
+    metrics.inc(name, amount)
@@ -0,0 +1,49 @@
+import threading
+
+import numpy as np
+
+
+class BlankTileFilter:
+    """Cheap check for tiles with no ink, which can skip the model
+
+    A tile is downsampled by taking the darkest channel of each
+    block of downsample x downsample pixels, so that thin strokes
+    survive. It is blank if at most max_ink_fraction of the downsampled
+    pixels are darker than ink_threshold and their standard deviation
+    is at most max_std. Blank tiles are labeled 'False' with the given
+    confidence. Counts of checked and skipped tiles are kept for
+    monitoring."""
+
+    def __init__(self, ink_threshold:int=200, max_ink_fraction:float=0.002,
+                 max_std:float=8., confidence:float=0.99, downsample:int=4):
+        self.ink_threshold = ink_threshold
+        self.max_ink_fraction = max_ink_fraction
+        self.max_std = max_std
+        self.confidence = confidence
+        self.downsample = downsample
+        self.tiles_checked = 0
+        self.tiles_skipped = 0
+        self._lock = threading.Lock()
+
+    def downsample_tile(self, tile:np.ndarray):
+        d = self.downsample
+        gray = np.asarray(tile).min(axis=-1)
+        pad_y, pad_x = -gray.shape[0] % d, -gray.shape[1] % d
+        if pad_y or pad_x:
+            gray = np.pad(gray, ((0, pad_y), (0, pad_x)), constant_values=255)
+        h, w = gray.shape
+        return gray.reshape(h//d, d, w//d, d).min(axis=(1, 3))
+
+    def is_blank(self, tile:np.ndarray):
+        gray = self.downsample_tile(tile)
+        blank = bool((gray < self.ink_threshold).mean() <= self.max_ink_fraction
+                     and gray.std() <= self.max_std)
+        with self._lock:
+            self.tiles_checked += 1
+            self.tiles_skipped += blank
+        return blank
+
+    def stats(self):
+        with self._lock:
+            return {'tiles_checked': self.tiles_checked,
+                    'tiles_skipped': self.tiles_skipped}
@@ -0,0 +1,241 @@
+"""Post-training int8 quantization for CPU inference
+
+Writes a quantized TorchScript artifact <checkpoint>_int8.torchscript.pt
+that the server loads with HKI_MODEL_BACKEND=torchscript and
+HKI_MODEL_CHECKPOINT=<checkpoint>_int8. Dynamic quantization only
+covers the linear layers of the classifier head, which gains little as
+the convolutions dominate. Static quantization also covers the
+convolutional backbone and needs a calibration set of tiles. The static
+mode uses eager mode quantization, which works with the torch 1.7 of
+the server image. The fx mode uses FX graph mode (torch >= 1.8) instead.
+
+Build the artifact with the torch version the server runs: a
+TorchScript artifact from a newer torch may not load in an older one.
+
+Given a held-out tile set, the accuracy and throughput of the quantized
+model are compared against the fp32 model:
+
+    python -m hki_sig_ml.quantize resnet34_data_aug_sigscale_best --path /app \
+        --mode static --calibration data/tiles/train --evaluate data/tiles/valid
+
+Tile sets are directories of images in subdirectories named by label
+(True / False), as read by fastai's parent_label.
+"""
+import argparse
+import copy
+import json
+import os
+from pathlib import Path
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import torch
+from torch import nn
+
+from .backends import TorchScriptBackend
+from .export import create_tile_classifier, get_metadata, save_torchscript
+from .inference import create_inference_model, iter_batches
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg']
+
+
+def torch_version():
+    # (major, minor) of the installed torch
+    return tuple(int(part) for part in torch.__version__.split('+')[0].split('.')[:2])
+
+
+def load_tiles(directory, tile_size:int=415, limit:int=None, seed:int=0):
+    # Load a labeled tile set as a (n_tiles, tile_size, tile_size, 3)
+    # uint8 array and a list of labels taken from the parent directory
+    paths = sorted(path for path in Path(directory).rglob('*')
+                   if path.suffix.lower() in IMAGE_EXTENSIONS)
+    if limit is not None and len(paths) > limit:
+        rng = np.random.default_rng(seed)
+        paths = [paths[i] for i in sorted(rng.choice(len(paths), limit, replace=False))]
+    tiles = np.stack([np.array(Image.open(path).convert('RGB').resize((tile_size, tile_size)))
+                      for path in paths])
+    return tiles, [path.parent.name for path in paths]
+
+
+class QuantizedBody(nn.Module):
+    """Quantize the input of a backbone and dequantize its output, so
+    that the head stays in fp32"""
+
+    def __init__(self, body:nn.Module):
+        super().__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.body = body
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.body(self.quant(x)))
+
+
+def _quantizable_blocks():
+    # torchvision's residual blocks and their quantizable subclasses,
+    # which only add a FloatFunctional for the skip connection
+    from torchvision.models.quantization.resnet import QuantizableBasicBlock
+    from torchvision.models.resnet import BasicBlock
+    try:
+        from torchvision.models.mobilenetv2 import InvertedResidual
+        from torchvision.models.quantization.mobilenetv2 import QuantizableInvertedResidual
+    except ImportError:
+        # torchvision < 0.11
+        from torchvision.models.mobilenet import InvertedResidual
+        from torchvision.models.quantization.mobilenet import QuantizableInvertedResidual
+    return [(BasicBlock, QuantizableBasicBlock, 'add_relu'),
+            (InvertedResidual, QuantizableInvertedResidual, 'skip_add')]
+
+
+def _make_quantizable(module:nn.Module):
+    # Swap the residual blocks of a resnet or mobilenet_v2 backbone for
+    # their quantizable versions in place
+    blocks = _quantizable_blocks()
+    for child in module.modules():
+        for block, quantizable, skip in blocks:
+            if type(child) is block:
+                child.__class__ = quantizable
+                setattr(child, skip, torch.nn.quantized.FloatFunctional())
+
+
+def _fuse(module:nn.Module):
+    # Fold batch norms (and a following ReLU) into the convolutions
+    from torchvision.models.quantization.resnet import QuantizableBasicBlock
+
+    if isinstance(module, QuantizableBasicBlock):
+        module.fuse_model()
+        return
+    for child in module.children():
+        _fuse(child)
+    if isinstance(module, nn.Sequential):
+        children = list(module.children())
+        groups = []
+        for i in range(len(children) - 1):
+            if isinstance(children[i], nn.Conv2d) and isinstance(children[i+1], nn.BatchNorm2d):
+                group = [str(i), str(i+1)]
+                if i+2 < len(children) and type(children[i+2]) is nn.ReLU:
+                    group.append(str(i+2))
+                groups.append(group)
+        if groups:
+            torch.quantization.fuse_modules(module, groups, inplace=True)
+
+
+def quantize(classifier:nn.Module, mode:str='dynamic', calibration:np.ndarray=None,
+             batch_size:int=32):
+    # Quantize the model inside a TileClassifier, keeping the uint8
+    # preprocessing and softmax in fp32
+    classifier = copy.deepcopy(classifier).eval()
+    if mode in ('static', 'fx') and calibration is None:
+        raise ValueError('Static quantization needs calibration tiles')
+    if mode == 'dynamic':
+        classifier.model = torch.quantization.quantize_dynamic(
+            classifier.model, {nn.Linear}, dtype=torch.qint8)
+    elif mode == 'static':
+        # Eager mode: the backbone (model[0] of a cnn_learner) is fused
+        # and quantized to int8, the head keeps its batch norms in fp32
+        # with its linear layers quantized dynamically
+        qconfig = torch.quantization.get_default_qconfig(torch.backends.quantized.engine)
+        body = classifier.model[0]
+        _make_quantizable(body)
+        _fuse(body)
+        classifier.model[0] = QuantizedBody(body)
+        classifier.model[0].qconfig = qconfig
+        torch.quantization.prepare(classifier.model, inplace=True)
+        with torch.no_grad():
+            for batch in iter_batches(calibration, batch_size):
+                classifier(torch.from_numpy(np.stack(batch)))
+        torch.quantization.convert(classifier.model, inplace=True)
+        classifier.model = torch.quantization.quantize_dynamic(
+            classifier.model, {nn.Linear}, dtype=torch.qint8)
+    elif mode == 'fx':
+        if torch_version() < (1, 8):
+            raise RuntimeError(f'FX graph mode quantization needs torch >= 1.8, '
+                               f'found {torch.__version__}, use --mode static')
+        from torch.quantization import get_default_qconfig
+        from torch.quantization.quantize_fx import convert_fx, prepare_fx
+
+        qconfig = get_default_qconfig(torch.backends.quantized.engine)
+        if torch_version() >= (1, 13):
+            # From torch 1.13 prepare_fx takes a QConfigMapping and needs
+            # example inputs to trace the model
+            from torch.ao.quantization import QConfigMapping
+
+            tile_size = calibration.shape[1]
+            classifier.model = prepare_fx(classifier.model,
+                                          QConfigMapping().set_global(qconfig),
+                                          example_inputs=(torch.zeros(1, 3, tile_size, tile_size),))
+        else:
+            classifier.model = prepare_fx(classifier.model, {'': qconfig})
+        with torch.no_grad():
+            for batch in iter_batches(calibration, batch_size):
+                classifier(torch.from_numpy(np.stack(batch)))
+        classifier.model = convert_fx(classifier.model)
+    else:
+        raise ValueError(f'Unknown quantization mode {mode}')
+    return classifier
+
+
+def evaluate(backend, tiles:np.ndarray, labels:list, batch_size:int=32):
+    # Accuracy and throughput of a backend on a labeled tile set
+    predictions = []
+    t0 = time.perf_counter()
+    for batch in iter_batches(tiles, batch_size):
+        predictions.extend(backend.predict_batch(np.stack(batch))[0])
+    duration = time.perf_counter() - t0
+    return {'accuracy': float(np.mean([p == l for p, l in zip(predictions, labels)])),
+            'tiles_per_second': len(tiles)/duration,
+            'artifact_bytes': os.path.getsize(backend.artifact)}
+
+
+def compare(fp32_backend, int8_backend, tiles:np.ndarray, labels:list,
+            batch_size:int=32):
+    fp32 = evaluate(fp32_backend, tiles, labels, batch_size)
+    int8 = evaluate(int8_backend, tiles, labels, batch_size)
+    return {'fp32': fp32,
+            'int8': int8,
+            'accuracy_change': int8['accuracy'] - fp32['accuracy'],
+            'speedup': int8['tiles_per_second']/fp32['tiles_per_second'],
+            'size_ratio': int8['artifact_bytes']/fp32['artifact_bytes']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('checkpoint', help='Checkpoint name, loaded from <path>/models/<checkpoint>.pth')
+    parser.add_argument('--model', default='resnet34', choices=['resnet18', 'resnet34', 'mobilenet_v2'])
+    parser.add_argument('--path', default='.')
+    parser.add_argument('--output', default=None, help='Output directory, defaults to --path')
+    parser.add_argument('--mode', default='dynamic', choices=['dynamic', 'static', 'fx'])
+    parser.add_argument('--calibration', default=None, help='Tile set for static and fx calibration')
+    parser.add_argument('--calibration-size', type=int, default=512)
+    parser.add_argument('--evaluate', default=None, help='Held-out tile set to compare against fp32')
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+
+    output = Path(args.path if args.output is None else args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    learner = create_inference_model(args.checkpoint, model=args.model, path=args.path)
+    classifier = create_tile_classifier(learner)
+
+    calibration = None
+    if args.calibration is not None:
+        calibration, _ = load_tiles(args.calibration, limit=args.calibration_size)
+    quantized = quantize(classifier, args.mode, calibration, args.batch_size)
+
+    artifact = output/f'{args.checkpoint}_int8.torchscript.pt'
+    metadata = {**get_metadata(learner, args.checkpoint, args.model),
+                'quantization': args.mode}
+    save_torchscript(quantized, artifact, metadata)
+    print('Wrote', artifact)
+
+    if args.evaluate is not None:
+        tiles, labels = load_tiles(args.evaluate)
+        with tempfile.TemporaryDirectory() as tmp:
+            fp32_artifact = Path(tmp)/f'{args.checkpoint}.torchscript.pt'
+            save_torchscript(classifier, fp32_artifact,
+                             get_metadata(learner, args.checkpoint, args.model))
+            report = compare(TorchScriptBackend(fp32_artifact), TorchScriptBackend(artifact),
+                             tiles, labels, args.batch_size)
+        print(json.dumps(report, indent=2))
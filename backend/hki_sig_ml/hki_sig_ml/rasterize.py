@@ -0,0 +1,196 @@
+import threading
+
+import numpy as np
+
+import PIL.Image
+
+import pdf2image
+
+from .metrics import stage
+from .utils import expand_image, get_tiles
+
+# Tiles are square with side length equal to A4 width
+A4_WIDTH = 8.3
+
+
+def get_tile_size(dpi:int):
+    return int(A4_WIDTH*dpi)
+
+
+# Rasterizers take a PDF document as bytes or as a file path, which lets
+# worker processes open a document from disk instead of being sent its
+# bytes with every page range
+
+
+class Pdf2ImageRasterizer:
+    """Render pages with poppler's pdftoppm through pdf2image"""
+    name = 'pdf2image'
+
+    def page_count(self, pdf):
+        if isinstance(pdf, bytes):
+            return pdf2image.pdfinfo_from_bytes(pdf)['Pages']
+        return pdf2image.pdfinfo_from_path(pdf)['Pages']
+
+    def render(self, pdf, dpi:int, first_page:int, last_page:int):
+        convert = (pdf2image.convert_from_bytes if isinstance(pdf, bytes)
+                   else pdf2image.convert_from_path)
+        pages = convert(pdf, dpi=dpi, first_page=first_page, last_page=last_page)
+        return [np.asarray(page if page.mode == 'RGB' else page.convert('RGB'))
+                for page in pages]
+
+
+class PyMuPDFRasterizer:
+    """Render pages in-process with PyMuPDF straight into arrays
+
+    MuPDF is not thread-safe, so calls from different threads of a
+    process are serialized. Use a process pool to render in parallel.
+    """
+    name = 'pymupdf'
+    _lock = threading.Lock()
+
+    def __init__(self):
+        import fitz
+        self.fitz = fitz
+
+    def _open(self, pdf):
+        if isinstance(pdf, bytes):
+            return self.fitz.open(stream=pdf, filetype='pdf')
+        return self.fitz.open(str(pdf), filetype='pdf')
+
+    def page_count(self, pdf):
+        with self._lock, self._open(pdf) as document:
+            return document.page_count
+
+    def render(self, pdf, dpi:int, first_page:int, last_page:int):
+        matrix = self.fitz.Matrix(dpi/72, dpi/72)
+        pages = []
+        with self._lock, self._open(pdf) as document:
+            for i in range(first_page-1, last_page):
+                pixmap = document[i].get_pixmap(matrix=matrix, alpha=False)
+                pages.append(np.frombuffer(pixmap.samples, dtype=np.uint8)
+                               .reshape(pixmap.height, pixmap.width, pixmap.n)[:, :, :3])
+        return pages
+
+
+class PdfiumRasterizer:
+    """Render pages in-process with pypdfium2 straight into arrays
+
+    PDFium is not thread-safe (concurrent renders crash the process),
+    so calls from different threads of a process are serialized. Use a
+    process pool to render in parallel.
+    """
+    name = 'pypdfium2'
+    _lock = threading.Lock()
+
+    def __init__(self):
+        import pypdfium2
+        self.pdfium = pypdfium2
+
+    def _open(self, pdf):
+        return self.pdfium.PdfDocument(pdf if isinstance(pdf, bytes) else str(pdf))
+
+    def page_count(self, pdf):
+        with self._lock:
+            document = self._open(pdf)
+            try:
+                return len(document)
+            finally:
+                document.close()
+
+    def render(self, pdf, dpi:int, first_page:int, last_page:int):
+        with self._lock:
+            document = self._open(pdf)
+            try:
+                # Copy out of the bitmap buffer, which is freed with the bitmap
+                return [np.array(document[i].render(scale=dpi/72, rev_byteorder=True)
+                                            .to_numpy()[:, :, :3])
+                        for i in range(first_page-1, last_page)]
+            finally:
+                document.close()
+
+
+RASTERIZERS = {rasterizer.name: rasterizer
+               for rasterizer in [PyMuPDFRasterizer, PdfiumRasterizer, Pdf2ImageRasterizer]}
+
+_rasterizers = {}
+
+
+def get_rasterizer(name:str='auto'):
+    # Get a rasterizer by name. 'auto' picks the first in-process
+    # backend that is installed and falls back to pdf2image.
+    if name not in _rasterizers:
+        if name == 'auto':
+            for candidate in RASTERIZERS:
+                try:
+                    _rasterizers[name] = get_rasterizer(candidate)
+                    break
+                except ImportError:
+                    continue
+        elif name in RASTERIZERS:
+            _rasterizers[name] = RASTERIZERS[name]()
+        else:
+            raise ValueError(f'Unknown rasterizer {name}, expected auto or one of {list(RASTERIZERS)}')
+    return _rasterizers[name]
+
+
+def get_page_count(pdf, rasterizer:str='auto'):
+    return get_rasterizer(rasterizer).page_count(pdf)
+
+
+def get_page_ranges(num_pages:int, window:int):
+    # Split pages 1..num_pages into (first_page, last_page) ranges of
+    # at most window pages
+    return [(first_page, min(first_page+window-1, num_pages))
+            for first_page in range(1, num_pages+1, window)]
+
+
+def iter_pages(pdf, dpi:int=50, window:int=8,
+               first_page:int=1, last_page:int=None, rasterizer:str='auto'):
+    # Rasterize a PDF document (bytes or a file path) window pages at a
+    # time, yielding
+    # (page number, HxWx3 uint8 page array) pairs. Only the current
+    # window of pages is held in memory and each page is dropped once
+    # it is consumed.
+    rasterizer = get_rasterizer(rasterizer)
+    if last_page is None:
+        with stage('decode'):
+            last_page = rasterizer.page_count(pdf)
+    for first, last in get_page_ranges(last_page-first_page+1, window):
+        first, last = first+first_page-1, last+first_page-1
+        with stage('rasterize'):
+            pages = rasterizer.render(pdf, dpi, first, last)
+        page_number = first
+        while pages:
+            yield page_number, pages.pop(0)
+            page_number += 1
+
+
+def get_page_pixels(page:np.ndarray, tile_size:int):
+    # Pad a page array to at least one tile. Pages smaller than a tile
+    # go through expand_image so they are padded the same way as before.
+    height, width = page.shape[:2]
+    if width >= tile_size and height >= tile_size:
+        return page
+    page = expand_image(PIL.Image.fromarray(np.ascontiguousarray(page)), tile_size, tile_size)
+    return np.asarray(page)
+
+
+def iter_page_tiles(pixels:np.ndarray, tile_size:int):
+    # Yield (tile number, tile extent, tile pixels) for a single page.
+    # The tile pixels are views into the page array, not copies.
+    for k, (x_start, y_start, x_stop, y_stop) in enumerate(get_tiles(pixels, tile_size)):
+        yield (k+1, [int(x_start), int(y_start), int(x_stop), int(y_stop)],
+               pixels[y_start:y_stop, x_start:x_stop])
+
+
+def rasterize_pages(pdf, dpi:int, first_page:int, last_page:int,
+                    rasterizer:str='auto'):
+    # Rasterize a range of pages to (page number, page pixels) pairs.
+    # Runs in a worker process, given the path of the document rather
+    # than its bytes, and the pages are tiled in the parent so that
+    # overlapping tiles are not copied between processes.
+    return [(page_number, get_page_pixels(page, get_tile_size(dpi)))
+            for page_number, page in iter_pages(pdf, dpi,
+                                                last_page-first_page+1,
+                                                first_page, last_page,
+                                                rasterizer)]
@@ -0,0 +1,124 @@
+"""Named models loaded on demand
+
+A ModelRegistry maps model names to (checkpoint, architecture, backend)
+specs. A model is loaded with backends.load_model the first time it is
+asked for, warmed up with a dummy batch and then kept for reuse. Once
+the loaded models together exceed the memory budget, the least recently
+used ones are dropped, except for the default model.
+"""
+import collections
+import itertools
+import os
+import threading
+
+import numpy as np
+
+from .backends import BACKENDS, load_model
+from .inference import predict_batch
+
+
+class UnknownModelError(KeyError):
+    pass
+
+
+def parse_models(spec:str):
+    # Parse 'name=checkpoint:architecture[:backend],...' into an ordered
+    # mapping of name to model spec
+    models = collections.OrderedDict()
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, _, value = item.strip().partition('=')
+        checkpoint, architecture, *backend = value.split(':')
+        backend = backend[0] if backend else 'fastai'
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {backend} for model {name}, '
+                             f'expected one of {BACKENDS}')
+        models[name] = {'checkpoint': checkpoint, 'model': architecture,
+                        'backend': backend}
+    return models
+
+
+def model_bytes(learner):
+    # Memory held by a loaded model's parameters and buffers, or the
+    # artifact size for backends that do not expose them
+    module = getattr(learner, 'model', None)
+    size = 0
+    if hasattr(module, 'parameters'):
+        size = sum(tensor.numel()*tensor.element_size()
+                   for tensor in itertools.chain(module.parameters(), module.buffers()))
+    if not size and getattr(learner, 'artifact', None) is not None:
+        size = os.path.getsize(learner.artifact)
+    return size
+
+
+def warm_up(learner, tile_size:int=415, batch_size:int=1):
+    # Run a dummy batch so that one-time initialization (lazy imports,
+    # allocator and kernel setup) does not land on the first request
+    predict_batch(np.zeros((batch_size, tile_size, tile_size, 3), dtype=np.uint8),
+                  learner)
+
+
+class ModelRegistry:
+    def __init__(self, models:dict, path='.', default:str=None,
+                 max_bytes:int=None, warmup:bool=True):
+        # models maps names to dicts with checkpoint, model (the
+        # architecture) and backend, as returned by parse_models. The
+        # default is the first model unless given.
+        if not models:
+            raise ValueError('No models configured')
+        self.models = collections.OrderedDict(models)
+        self.path = path
+        self.default = next(iter(self.models)) if default is None else default
+        self.max_bytes = max_bytes
+        self.warmup = warmup
+        self._loaded = collections.OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._loading = collections.defaultdict(threading.Lock)
+
+    def get(self, name:str=None):
+        # Return the named model, loading it if needed
+        name = self.default if name is None else name
+        if name not in self.models:
+            raise UnknownModelError(name)
+        with self._lock:
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+                return self._loaded[name]
+            loading = self._loading[name]
+
+        # Concurrent requests for the same model wait for a single load
+        with loading:
+            with self._lock:
+                if name in self._loaded:
+                    self._loaded.move_to_end(name)
+                    return self._loaded[name]
+            spec = self.models[name]
+            learner = load_model(spec['checkpoint'], model=spec['model'], path=self.path,
+                                 backend=spec['backend'])
+            if self.warmup:
+                warm_up(learner)
+            with self._lock:
+                self._loaded[name] = learner
+                self._sizes[name] = model_bytes(learner)
+                self._evict(keep=name)
+            return learner
+
+    def _evict(self, keep:str):
+        # Requests still using an evicted model keep their reference
+        if self.max_bytes is None:
+            return
+        for name in list(self._loaded):
+            if sum(self._sizes.values()) <= self.max_bytes:
+                break
+            if name in (keep, self.default):
+                continue
+            del self._loaded[name]
+            del self._sizes[name]
+
+    def loaded(self):
+        # Names and sizes in bytes of the loaded models, least recently
+        # used first
+        with self._lock:
+            return collections.OrderedDict((name, self._sizes[name]) for name in self._loaded)
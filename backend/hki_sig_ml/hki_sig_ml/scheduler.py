@@ -0,0 +1,84 @@
+import collections
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+import numpy as np
+
+from .inference import iter_batches, predict_batch
+from .metrics import stage
+
+
+class BatchScheduler:
+    """Shared inference scheduler that batches tiles across callers
+
+    Tiles submitted from any thread are collected into batches of at
+    most max_batch_size tiles. A batch is run as soon as it is full or
+    max_wait_ms milliseconds after its first tile arrived, so the extra
+    latency per tile is bounded by max_wait_ms plus one forward pass.
+    All forward passes run on the scheduler's own thread."""
+
+    def __init__(self, learner, max_batch_size:int=64, max_wait_ms:float=10):
+        self.learner = learner
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms/1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='batch-scheduler',
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, tile):
+        # Queue a single tile, the future resolves to (label, confidence)
+        future = Future()
+        self._queue.put((np.asarray(tile), future))
+        return future
+
+    def predict(self, pdf_tiles):
+        # Same interface as inference.predict. Tiles are submitted a
+        # batch at a time with at most two batches in flight, so a
+        # streamed iterable is not buffered in full.
+        labels, confidences = [], []
+        pending = collections.deque()
+
+        def collect(futures):
+            for future in futures:
+                # Inference runs on the scheduler thread, so the request
+                # sees the time it waits for its results
+                with stage('inference'):
+                    label, confidence = future.result()
+                labels.append(label)
+                confidences.append(confidence)
+
+        for batch in iter_batches(pdf_tiles, self.max_batch_size):
+            pending.append([self.submit(tile) for tile in batch])
+            if len(pending) > 1:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+        return labels, confidences
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            tiles, futures = zip(*self._next_batch())
+            try:
+                labels, confidences = predict_batch(np.stack(tiles), self.learner)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, label, confidence in zip(futures, labels, confidences):
+                future.set_result((label, confidence))
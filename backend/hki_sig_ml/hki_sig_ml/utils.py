@@ -1,19 +1,22 @@
-import itertools
 import numpy as np
 import PIL
+import PIL.ImageOps
 
 
-def get_tiles(image: PIL.Image.Image, tile_size: int):
-    # Get a list of tile extents given the tile size
-    n_x, n_y = int(np.ceil(image.width/tile_size)), int(np.ceil(image.height/tile_size))
-    offset_x = np.linspace(0, image.width-tile_size, n_x).astype(int)
-    offset_y = np.linspace(0, image.height-tile_size, n_y).astype(int)
-    positions = [{'x_start': x, 
-                  'x_stop': x+tile_size, 
-                  'y_start': y, 
-                  'y_stop': y+tile_size} 
-                  for x,y in itertools.product(offset_x, offset_y)]
-    return positions
+def get_tiles(image, tile_size: int):
+    # Get an (n_tiles, 4) array of tile extents (x_start, y_start,
+    # x_stop, y_stop) given the tile size. image is a PIL image or an
+    # HxWxC array.
+    if isinstance(image, PIL.Image.Image):
+        width, height = image.width, image.height
+    else:
+        height, width = image.shape[:2]
+    n_x, n_y = int(np.ceil(width/tile_size)), int(np.ceil(height/tile_size))
+    offset_x = np.linspace(0, width-tile_size, n_x).astype(int)
+    offset_y = np.linspace(0, height-tile_size, n_y).astype(int)
+    x, y = np.meshgrid(offset_x, offset_y, indexing='ij')
+    x, y = x.ravel(), y.ravel()
+    return np.stack([x, y, x+tile_size, y+tile_size], axis=1)
 
 
 def expand_image(image:PIL.Image.Image, minimum_width:int, minimum_height:int):
@@ -0,0 +1,182 @@
+"""Whole page inference with a shared backbone
+
+The backbone of a cnn_learner model is fully convolutional, so instead of
+running it on each of the overlapping tiles of a page, it is run once
+over the whole padded page. The head, which starts by pooling the
+features, is then applied to every tile-sized window of the feature
+map. Each tile is scored by the window at its position, and the window
+scores together are a coarse heatmap of the signature probability over
+the page.
+
+Window positions are rounded to the backbone stride (32 pixels for
+resnet and mobilenet_v2), and tiles see their neighbourhood through the
+receptive field instead of the zero padding at tile edges, so the scores
+are close to, but not the same as, scoring each tile on its own.
+validate() measures the agreement and the time of both paths:
+
+    python -m hki_sig_ml.wholepage resnet34_data_aug_sigscale_best --path /app documents/*.pdf
+
+Only fastai Learners are supported, the exported backends do not expose
+the backbone.
+"""
+import argparse
+import json
+from pathlib import Path
+import time
+
+import numpy as np
+import pandas as pd
+
+import torch
+import torch.nn.functional as F
+
+from .inference import _tile_info, iter_document_pages, predict
+from .metrics import stage
+from .rasterize import get_tile_size, iter_page_tiles
+
+
+def page_features(pixels:np.ndarray, learner):
+    # Backbone features of a HxWx3 uint8 page, preprocessed with the
+    # same after_batch transforms as a batch of tiles
+    from fastai.vision.core import TensorImage
+
+    with stage('preprocess'):
+        x = torch.from_numpy(np.ascontiguousarray(pixels[None])).permute(0, 3, 1, 2)
+        x = learner.dls.after_batch(TensorImage(x.to(learner.dls.device)))
+    with stage('inference'), torch.no_grad():
+        return learner.model[0](x)
+
+
+def window_probabilities(features:torch.Tensor, window:tuple, learner):
+    # Class probabilities of the head applied to every window of the
+    # feature map, as a (rows, columns, classes) tensor
+    from fastai.layers import AdaptiveConcatPool2d
+
+    head = learner.model[1]
+    pool = head[0]
+    if isinstance(pool, AdaptiveConcatPool2d):
+        pooled = torch.cat([F.max_pool2d(features, window, stride=1),
+                            F.avg_pool2d(features, window, stride=1)], dim=1)
+    elif isinstance(pool, torch.nn.AdaptiveAvgPool2d):
+        pooled = F.avg_pool2d(features, window, stride=1)
+    elif isinstance(pool, torch.nn.AdaptiveMaxPool2d):
+        pooled = F.max_pool2d(features, window, stride=1)
+    else:
+        raise ValueError(f'Unsupported head pooling {type(pool).__name__}')
+
+    rows, columns = pooled.shape[2:]
+    pooled = pooled.permute(0, 2, 3, 1).reshape(rows*columns, -1, 1, 1)
+    activation = getattr(learner.loss_func, 'activation', None)
+    with stage('inference'), torch.no_grad():
+        output = head[1:](pooled)
+        probs = activation(output) if activation is not None else torch.softmax(output, dim=-1)
+    return probs.reshape(rows, columns, -1)
+
+
+def predict_page(pixels:np.ndarray, learner, tile_size:int):
+    # Score the tiles of a page (padded to at least one tile) as placed by
+    # iter_page_tiles, returning a list of (tile number, tile extent,
+    # label, confidence) and the page's heatmap of signature probability
+    learner.model.eval()
+    features = page_features(pixels, learner)
+    stride_y = pixels.shape[0]/features.shape[2]
+    stride_x = pixels.shape[1]/features.shape[3]
+    window = (max(1, min(int(round(tile_size/stride_y)), features.shape[2])),
+              max(1, min(int(round(tile_size/stride_x)), features.shape[3])))
+    probs = window_probabilities(features, window, learner).cpu().numpy()
+
+    vocab = [str(label) for label in learner.dls.vocab]
+    tiles = []
+    for k, extent, _ in iter_page_tiles(pixels, tile_size):
+        row = min(int(round(extent[1]/stride_y)), probs.shape[0]-1)
+        column = min(int(round(extent[0]/stride_x)), probs.shape[1]-1)
+        tile_probs = probs[row, column]
+        tiles.append((k, extent, vocab[tile_probs.argmax()], float(tile_probs.max())))
+    heatmap = probs[..., vocab.index('True')] if 'True' in vocab else probs.max(axis=-1)
+    return tiles, heatmap
+
+
+def classify_pages(pages, learner, dpi:int=50, heatmaps:dict=None):
+    # Score a (document, page number, pixels) stream page by page,
+    # returning tile infos, labels and confidences like the tile path.
+    # Page heatmaps are stored in heatmaps by (document, page) if given.
+    tile_size = get_tile_size(dpi)
+    info, labels, confidences = [], [], []
+    for pdf, page_number, pixels in pages:
+        tiles, heatmap = predict_page(pixels, learner, tile_size)
+        for k, extent, label, confidence in tiles:
+            info.append(_tile_info(pdf, page_number, k, extent))
+            labels.append(label)
+            confidences.append(confidence)
+        if heatmaps is not None:
+            heatmaps[(pdf['filename'], page_number)] = heatmap
+    return info, labels, confidences
+
+
+def _signature_probability(labels, confidences):
+    return np.where(np.array(labels) == 'True', confidences, 1. - np.array(confidences))
+
+
+def validate(pdf_documents:list, learner, dpi:int=50, window:int=8, batch_size:int=64):
+    # Score every tile with both paths, returning a report of their
+    # agreement and time, and the per tile comparison
+    tile_size = get_tile_size(dpi)
+    rows = []
+    whole_page_s = per_tile_s = 0.
+    for pdf, page_number, pixels in iter_document_pages(pdf_documents, dpi, window):
+        t0 = time.perf_counter()
+        tiles, _ = predict_page(pixels, learner, tile_size)
+        t1 = time.perf_counter()
+        tile_labels, tile_confidences = predict(
+            (tile for _, _, tile in iter_page_tiles(pixels, tile_size)), learner, batch_size)
+        t2 = time.perf_counter()
+        whole_page_s += t1 - t0
+        per_tile_s += t2 - t1
+        for (k, extent, label, confidence), tile_label, tile_confidence in zip(
+                tiles, tile_labels, tile_confidences):
+            rows.append({'document': pdf['filename'], 'page': page_number, 'tile': k,
+                         'tile_extent': extent,
+                         'whole_page_label': label, 'whole_page_confidence': confidence,
+                         'tile_label': tile_label, 'tile_confidence': tile_confidence})
+
+    df = pd.DataFrame(rows)
+    if not len(df):
+        return {'tiles': 0}, df
+    probability_difference = np.abs(
+        _signature_probability(df.whole_page_label, df.whole_page_confidence)
+        - _signature_probability(df.tile_label, df.tile_confidence))
+    pages = (df.assign(whole_page_positive=df.whole_page_label == 'True',
+                       tile_positive=df.tile_label == 'True')
+               .groupby(['document', 'page'])[['whole_page_positive', 'tile_positive']].any())
+    report = {'tiles': len(df),
+              'pages': len(pages),
+              'tile_agreement': float((df.whole_page_label == df.tile_label).mean()),
+              'page_agreement': float((pages.whole_page_positive == pages.tile_positive).mean()),
+              'mean_probability_difference': float(probability_difference.mean()),
+              'max_probability_difference': float(probability_difference.max()),
+              'whole_page_s': whole_page_s,
+              'per_tile_s': per_tile_s,
+              'speedup': per_tile_s/whole_page_s if whole_page_s > 0 else None}
+    return report, df
+
+
+if __name__ == '__main__':
+    from .inference import create_inference_model
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('checkpoint', help='Checkpoint name, loaded from <path>/models/<checkpoint>.pth')
+    parser.add_argument('documents', nargs='+', help='PDF files to compare the paths on')
+    parser.add_argument('--model', default='resnet34', choices=['resnet18', 'resnet34', 'mobilenet_v2'])
+    parser.add_argument('--path', default='.')
+    parser.add_argument('--dpi', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--details', default=None, help='Write the per tile comparison to this CSV file')
+    args = parser.parse_args()
+
+    learner = create_inference_model(args.checkpoint, model=args.model, path=args.path)
+    pdf_documents = [{'filename': path, 'bytes': Path(path).read_bytes()}
+                     for path in args.documents]
+    report, df = validate(pdf_documents, learner, dpi=args.dpi, batch_size=args.batch_size)
+    print(json.dumps(report, indent=2))
+    if args.details is not None:
+        df.to_csv(args.details, index=False)
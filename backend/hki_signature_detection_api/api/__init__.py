@@ -1,3 +1,6 @@
 from .dummy import DummyEndpoint
 from .dummy import HelloEndpoint
-from .analyze import AnalysisEndpoint
\ No newline at end of file
+from .analyze import AnalysisEndpoint, load_models, start_background
+from .jobs import JobsEndpoint, JobEndpoint, start_job_workers
+from .metrics import metrics
+from .health import health, ready
@@ -1,42 +1,262 @@
 import base64
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
 import random
+import threading
 import time
+import traceback
 
-from flask import request
-from flask_restful import Resource, Api, marshal_with, fields, abort
+from flask import Response, request
+from flask_restful import Resource, Api, marshal, marshal_with, fields, abort
 from flask_restful_swagger import swagger
 from PyPDF4.pdf import PdfFileReader
 from PyPDF4.utils import PyPdfError
+import pandas as pd
 
-from hki_sig_ml.inference import create_inference_model, classify
+from hki_sig_ml.backends import load_model
+from hki_sig_ml.cache import ResultCache, classify_cached
+from hki_sig_ml.cascade import PageScreener
+from hki_sig_ml.metrics import StageTimings, stage
+from hki_sig_ml.prefilter import BlankTileFilter
+from hki_sig_ml.rasterize import get_rasterizer
+from hki_sig_ml.registry import ModelRegistry, parse_models
+from hki_sig_ml.scheduler import BatchScheduler
 
-from .models import AnalysisResult
+from .. import config
+from .errors import NotReadyError
+from .models import AnalysisResult, AnalysisSummary, DocumentResult
 
-learner = create_inference_model('resnet34_data_aug_sigscale_best', path='/app', model='resnet34')
+# Models are loaded by load_models, so that the fastai and torch imports
+# and model construction can run after the server is up
+registry = ModelRegistry(parse_models(config.MODELS), path=config.MODEL_PATH,
+                         max_bytes=config.MODEL_MEMORY_BUDGET,
+                         warmup=config.MODEL_WARMUP)
+screener = None
 
-class AnalysisEndpoint(Resource):
-    @swagger.operation(
-        responseClass=AnalysisResult.__name__,
-        nickname='analyze'
-    )
-    @marshal_with(AnalysisResult.resource_fields)
-    def post(self):
-        """Return a AnalysisResult object"""
-        # Get PDF documents
-        pdf_documents = [{'filename': filename, 'bytes': file_stream.read()} for
-            filename, file_stream in request.files.items()]
+prefilter = None
+if config.PREFILTER_ENABLED:
+    prefilter = BlankTileFilter(ink_threshold=config.PREFILTER_INK_THRESHOLD,
+                                max_ink_fraction=config.PREFILTER_MAX_INK_FRACTION,
+                                max_std=config.PREFILTER_MAX_STD,
+                                confidence=config.PREFILTER_CONFIDENCE)
+
+# Pipeline options that change the results are part of the cache key
+cache_variant = (f'rasterizer={get_rasterizer(config.RASTERIZER).name};'
+                 f'early_exit={config.EARLY_EXIT_THRESHOLD}')
+if prefilter is not None:
+    cache_variant += (f';prefilter={prefilter.ink_threshold},{prefilter.max_ink_fraction},'
+                      f'{prefilter.max_std},{prefilter.confidence}')
+if config.SCREEN_CHECKPOINT is not None:
+    cache_variant += (f';screen={config.SCREEN_CHECKPOINT},{config.SCREEN_ARCHITECTURE},'
+                      f'{config.SCREEN_THRESHOLD},{config.SCREEN_WIDTH}x{config.SCREEN_HEIGHT}')
+
+result_cache = ResultCache(max_entries=config.CACHE_ENTRIES,
+                           path=config.CACHE_PATH,
+                           max_bytes=config.CACHE_MAX_BYTES,
+                           max_age=config.CACHE_MAX_AGE)
+
+# Background threads and processes are started per server process by
+# start_background, since they do not survive a fork of a preloaded app
+scheduler = None
+rasterize_pool = None
+
+# Set once the models are loaded and requests can be analysed. A
+# failed load is kept in load_error.
+ready = threading.Event()
+load_error = None
+
+
+def load_models():
+    # Load the default model (others are loaded on first use) and the
+    # screening model. Safe to call again once loaded.
+    global screener
+
+    registry.get()
+    if config.SCREEN_CHECKPOINT is not None and screener is None:
+        screener = PageScreener(load_model(config.SCREEN_CHECKPOINT, path=config.MODEL_PATH,
+                                           model=config.SCREEN_ARCHITECTURE,
+                                           backend=config.SCREEN_BACKEND),
+                                threshold=config.SCREEN_THRESHOLD,
+                                size=(config.SCREEN_WIDTH, config.SCREEN_HEIGHT),
+                                batch_size=config.SCREEN_BATCH_SIZE)
+
+
+def _start_inference():
+    global scheduler, load_error
+
+    try:
+        load_models()
+        # Tiles from concurrent requests for the default model share
+        # inference batches
+        if config.INFERENCE_MAX_WAIT_MS > 0:
+            scheduler = BatchScheduler(registry.get(), max_batch_size=config.INFERENCE_BATCH_SIZE,
+                                       max_wait_ms=config.INFERENCE_MAX_WAIT_MS)
+    except Exception as e:
+        traceback.print_exc()
+        load_error = f'{type(e).__name__}: {e}'
+        raise
+    ready.set()
+
+
+def wait_ready(poll:float=1.0):
+    # Block until the models are loaded, raising if loading failed
+    while not ready.wait(poll):
+        if load_error is not None:
+            raise RuntimeError(f'Models failed to load: {load_error}')
+
+
+def start_background(fast_start:bool=False):
+    # With fast_start, the models are loaded on a background thread and
+    # requests to /analyze answer 503 until they are ready
+    global rasterize_pool
+
+    # Rasterization workers are spawned rather than forked so that they
+    # do not inherit the torch thread pools of the server process
+    if config.RASTERIZE_WORKERS > 0:
+        rasterize_pool = ProcessPoolExecutor(config.RASTERIZE_WORKERS,
+                                             mp_context=multiprocessing.get_context('spawn'))
 
+    if fast_start:
+        threading.Thread(target=_start_inference, name='model-loader', daemon=True).start()
+    else:
+        _start_inference()
+
+
+def get_pdf_documents():
+    # Get PDF documents from the uploaded files
+    return [{'filename': filename, 'bytes': file_stream.read()} for
+        filename, file_stream in request.files.items()]
+
+
+def _get_model(model:str=None):
+    # (name, model) for a model name in the registry, the default model
+    # if not given
+    if not ready.is_set():
+        raise NotReadyError()
+    model = registry.default if model is None else model
+    return model, registry.get(model)
+
+
+def _classify(pdf_documents:list, model:str, learner, progress=None):
+    spec = registry.models[model]
+    whole_page = config.WHOLE_PAGE_INFERENCE and spec['backend'] == 'fastai'
+    return classify_cached(pdf_documents, learner, result_cache,
+                           checkpoint=spec['checkpoint'],
+                           model=spec['model'],
+                           dpi=config.TILE_DPI,
+                           variant=cache_variant + (';whole_page' if whole_page else ''),
+                           batch_size=config.INFERENCE_BATCH_SIZE,
+                           window=config.RASTERIZE_PAGE_WINDOW,
+                           executor=rasterize_pool,
+                           max_pending=2*config.RASTERIZE_WORKERS,
+                           scheduler=scheduler if model == registry.default else None,
+                           prefilter=prefilter,
+                           early_exit_threshold=config.EARLY_EXIT_THRESHOLD,
+                           rasterizer=config.RASTERIZER,
+                           screener=screener,
+                           whole_page=whole_page,
+                           progress=progress)
+
+
+def analyze(pdf_documents:list, progress=None, timings:bool=False, model:str=None,
+            csv:bool=True, encode:bool=False):
+    # Returns a marshalled AnalysisResult, with the time spent in each
+    # pipeline stage if timings is set and the details as a CSV data URI
+    # if csv is set. model names a model in the registry, the default
+    # model if not given. With encode, the result is returned as JSON,
+    # so that the encoding is timed as part of the serialize stage.
+    model, learner = _get_model(model)
+    with StageTimings() as stage_timings:
         # Classify pages
         t0 = time.time()
-        results, details = classify(pdf_documents, learner)
+        results, details = _classify(pdf_documents, model, learner, progress)
         classification_duration = time.time() - t0
 
-        # Package results in CSV
-        csv = base64.b64encode(details.to_csv().encode('utf-8')).decode('ascii')
-        csv = f'data:text/csv;base64,{csv}'
-        
-        # Package results to dict
-        results = results.to_dict(orient='records')
-        details = details.to_dict(orient='records')
+        with stage('serialize'):
+            # Package results in CSV
+            if csv:
+                csv = base64.b64encode(details.to_csv().encode('utf-8')).decode('ascii')
+                csv = f'data:text/csv;base64,{csv}'
+            else:
+                csv = None
+            
+            # Package results to dict
+            results = results.to_dict(orient='records')
+            details = details.to_dict(orient='records')
+            result = marshal(AnalysisResult(results, details, csv, classification_duration,
+                                            None, model),
+                             AnalysisResult.resource_fields)
+            if encode:
+                body = json.dumps(result)
+
+    if timings:
+        result['timings'] = dict(stage_timings.durations)
+        if encode:
+            # Encode again to include the timings, which cover the first
+            # encoding
+            body = json.dumps(result)
+    return body if encode else result
 
-        return AnalysisResult(results, details, csv, classification_duration)
+
+def analyze_stream(pdf_documents:list, timings:bool=False, model:str=None):
+    # Returns a generator of NDJSON lines: a DocumentResult as each
+    # document is classified, then an AnalysisSummary. Documents are
+    # classified one at a time so that their results are sent early.
+    model, learner = _get_model(model)
+
+    def lines():
+        with StageTimings() as stage_timings:
+            t0 = time.time()
+            for pdf in pdf_documents:
+                results, details = _classify([pdf], model, learner)
+                # Lines are yielded outside the stage, so that the time
+                # spent sending them is not counted
+                with stage('serialize'):
+                    document_lines = []
+                    for result in results.to_dict(orient='records'):
+                        result['details'] = [row for row in details.to_dict(orient='records')
+                                             if row['document'] == result['document']]
+                        document_lines.append(json.dumps(marshal(
+                            DocumentResult(result), DocumentResult.resource_fields)) + '\n')
+                yield from document_lines
+            classification_duration = time.time() - t0
+        summary = AnalysisSummary(len(pdf_documents), classification_duration,
+                                  dict(stage_timings.durations) if timings else None,
+                                  model)
+        yield json.dumps(marshal(summary, AnalysisSummary.resource_fields)) + '\n'
+
+    return lines()
+
+
+class AnalysisEndpoint(Resource):
+    @swagger.operation(
+        responseClass=AnalysisResult.__name__,
+        nickname='analyze',
+        responseMessages=[
+            {"code": 400, "message": "Unknown model or format"},
+            {"code": 503, "message": "Models are still loading"},
+        ])
+    def post(self):
+        """Return a AnalysisResult object
+        With ?timings=1 the result includes the time spent in each stage,
+        ?model=<name> picks a model from HKI_MODELS and ?csv=0 leaves out
+        the CSV. With ?format=ndjson the response is streamed as a
+        DocumentResult line per document followed by an AnalysisSummary
+        line, and ?format=csv returns the details as a CSV file."""
+        output = request.args.get('format', 'json')
+        timings = request.args.get('timings') in ('1', 'true')
+        model = request.args.get('model')
+        if output == 'ndjson':
+            return Response(analyze_stream(get_pdf_documents(), timings=timings, model=model),
+                            mimetype='application/x-ndjson')
+        if output == 'csv':
+            result = analyze(get_pdf_documents(), timings=timings, model=model, csv=False)
+            return Response(pd.DataFrame(result['details']).to_csv(), mimetype='text/csv',
+                            headers={'Content-Disposition': 'attachment; filename=details.csv'})
+        if output != 'json':
+            abort(400, message=f'Unknown format {output}, expected json, ndjson or csv')
+        return Response(analyze(get_pdf_documents(), timings=timings, model=model,
+                                csv=request.args.get('csv') not in ('0', 'false'),
+                                encode=True),
+                        mimetype='application/json')
@@ -3,4 +3,8 @@ class JsonRequiredError(Exception):
 
 
 class JsonInvalidError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class NotReadyError(Exception):
+    pass
@@ -0,0 +1,18 @@
+from flask import jsonify
+
+from . import analyze
+
+
+def health():
+    """Liveness check, answers as soon as the server is up"""
+    return jsonify(status='ok')
+
+
+def ready():
+    """Readiness check, 503 until the models are loaded and /analyze can
+    answer"""
+    if analyze.ready.is_set():
+        return jsonify(status='ready', models=list(analyze.registry.loaded()))
+    if analyze.load_error is not None:
+        return jsonify(status='failed', error=analyze.load_error), 503
+    return jsonify(status='loading'), 503
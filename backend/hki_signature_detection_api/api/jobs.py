@@ -0,0 +1,77 @@
+from flask import request
+from flask_restful import Resource, marshal_with, abort
+from flask_restful_swagger import swagger
+
+from hki_sig_ml.rasterize import get_page_count
+from hki_sig_ml.registry import UnknownModelError
+
+from .. import config
+from ..jobs import create_job_queue, start_workers
+from .analyze import analyze, get_pdf_documents, registry, wait_ready
+from .models import JobResult
+
+job_queue = create_job_queue(config.JOB_QUEUE_URL, max_size=config.JOB_QUEUE_SIZE)
+
+
+def run_job(job_id:str, payload:dict):
+    pdf_documents = payload['documents']
+    pages_total = 0
+    for pdf in pdf_documents:
+        try:
+            pages_total += get_page_count(pdf['bytes'], config.RASTERIZER)
+        except Exception:
+            pass
+    job_queue.update(job_id, pages_total=pages_total)
+
+    # Jobs accepted while the models load wait for them, and fail if
+    # the models cannot be loaded
+    wait_ready()
+    result = analyze(pdf_documents,
+                     progress=lambda document, page: job_queue.increment(job_id, 'pages_done'),
+                     timings=payload['timings'],
+                     model=payload.get('model'),
+                     csv=payload.get('csv', True))
+    # Cached documents are not rasterized, so they do not report progress
+    job_queue.update(job_id, pages_done=pages_total)
+    return result
+
+
+def start_job_workers():
+    return start_workers(job_queue, run_job, config.JOB_WORKERS)
+
+
+class JobsEndpoint(Resource):
+    @swagger.operation(
+        responseClass=JobResult.__name__,
+        nickname='submit_job',
+        responseMessages=[
+            {"code": 400, "message": "Unknown model"},
+            {"code": 429, "message": "Job queue full"},
+        ])
+    @marshal_with(JobResult.resource_fields)
+    def post(self):
+        """Queue the uploaded documents for analysis and return a JobResult object"""
+        model = request.args.get('model')
+        if model is not None and model not in registry.models:
+            raise UnknownModelError(model)
+        job_id = job_queue.submit({'documents': get_pdf_documents(),
+                                   'timings': request.args.get('timings') in ('1', 'true'),
+                                   'model': model,
+                                   'csv': request.args.get('csv') not in ('0', 'false')})
+        return JobResult(job_queue.get(job_id)), 202
+
+
+class JobEndpoint(Resource):
+    @swagger.operation(
+        responseClass=JobResult.__name__,
+        nickname='get_job',
+        responseMessages=[
+            {"code": 404, "message": "Job not found"},
+        ])
+    @marshal_with(JobResult.resource_fields)
+    def get(self, job_id):
+        """Return a JobResult object with the progress and, once done, the AnalysisResult"""
+        job = job_queue.get(job_id)
+        if job is None:
+            abort(404, message=f'Job {job_id} not found')
+        return JobResult(job)
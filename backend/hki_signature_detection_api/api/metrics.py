@@ -0,0 +1,10 @@
+from flask import Response
+
+from hki_sig_ml.metrics import METRICS
+
+
+def metrics():
+    """Pipeline stage histograms and counters in the Prometheus text format
+
+    The metrics are per server process."""
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
@@ -30,7 +30,8 @@ class AnalysisResult:
         'status': fields.String,
         'message': fields.String,
         'num_pages': fields.Integer,
-        'positive': fields.List(fields.Integer)
+        'positive': fields.List(fields.Integer),
+        'cache': fields.String,
     }
     detail_fields = {
         'document': fields.String,
@@ -38,6 +39,8 @@ class AnalysisResult:
         'page': fields.Integer,
         'label': fields.String,
         'confidence': fields.Float,
+        'screen_label': fields.String,
+        'screen_confidence': fields.Float,
     }
     resource_fields = {
         'num_files': fields.Integer,
@@ -45,11 +48,64 @@ class AnalysisResult:
         'details': fields.List(fields.Nested(detail_fields)),
         'csv': fields.Raw,
         'classification_duration': fields.Float,
+        'timings': fields.Raw,
+        'model': fields.String,
     }
 
-    def __init__(self, results, details, csv, classification_duration):
+    def __init__(self, results, details, csv, classification_duration, timings=None,
+                 model=None):
         self.num_files = len(results)
         self.results = results
         self.details = details
         self.csv = csv
-        self.classification_duration = classification_duration
\ No newline at end of file
+        self.classification_duration = classification_duration
+        self.timings = timings
+        self.model = model
+
+@swagger.model
+class DocumentResult:
+    """A document's line in the ?format=ndjson response of /analyze"""
+    resource_fields = {
+        **AnalysisResult.file_fields,
+        'details': fields.List(fields.Nested(AnalysisResult.detail_fields)),
+    }
+
+    def __init__(self, result):
+        for field in self.resource_fields:
+            setattr(self, field, result.get(field))
+
+@swagger.model
+class AnalysisSummary:
+    """The last line of the ?format=ndjson response of /analyze"""
+    resource_fields = {
+        'num_files': fields.Integer,
+        'classification_duration': fields.Float,
+        'timings': fields.Raw,
+        'model': fields.String,
+    }
+
+    def __init__(self, num_files, classification_duration, timings=None, model=None):
+        self.num_files = num_files
+        self.classification_duration = classification_duration
+        self.timings = timings
+        self.model = model
+
+@swagger.model
+class JobResult:
+    """The result of a call to /jobs or /jobs/<job_id>"""
+    resource_fields = {
+        'id': fields.String,
+        'status': fields.String,
+        'pages_done': fields.Integer,
+        'pages_total': fields.Integer,
+        'error': fields.String,
+        'result': fields.Nested(AnalysisResult.resource_fields, allow_null=True),
+    }
+
+    def __init__(self, job):
+        self.id = job['id']
+        self.status = job['status']
+        self.pages_done = job['pages_done']
+        self.pages_total = job['pages_total']
+        self.error = job['error']
+        self.result = job['result']
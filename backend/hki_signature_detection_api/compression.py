@@ -0,0 +1,83 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ['application/json', 'application/x-ndjson', 'text/csv',
+                          'text/plain']
+
+
+def get_encodings():
+    # Supported content codings, preferred first
+    return (['br'] if brotli is not None else []) + ['gzip']
+
+
+def negotiate_encoding(accept_encodings):
+    # The supported coding the client accepts with the highest quality,
+    # or None
+    candidates = [(accept_encodings[encoding], -i, encoding)
+                  for i, encoding in enumerate(get_encodings())]
+    quality, _, encoding = max(candidates)
+    return encoding if quality > 0 else None
+
+
+class Compressor:
+    """Incremental gzip or brotli compressor. With flush, the output so
+    far can be decompressed on arrival, e.g. one NDJSON line at a time."""
+
+    def __init__(self, encoding:str):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=5)
+        else:
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data:bytes, flush:bool=False):
+        if self.encoding == 'br':
+            output = self._compressor.process(data)
+            return output + self._compressor.flush() if flush else output
+        output = self._compressor.compress(data)
+        return output + self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else output
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def _compress_stream(chunks, compressor:Compressor):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        output = compressor.compress(chunk, flush=True)
+        if output:
+            yield output
+    yield compressor.finish()
+
+
+def compress_response(response, accept_encodings, min_size:int=1024):
+    # Compress a Flask response with the coding negotiated from the
+    # request's Accept-Encoding. Streamed responses are compressed chunk
+    # by chunk, others only if they are at least min_size bytes.
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(accept_encodings)
+    if encoding is None:
+        return response
+
+    compressor = Compressor(encoding)
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compressor.compress(data) + compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,124 @@
+import os
+
+# Server configuration, read from the environment so that it can be set
+# per container in docker-compose.
+
+# Number of tiles stacked into a single forward pass
+INFERENCE_BATCH_SIZE = int(os.environ.get('HKI_INFERENCE_BATCH_SIZE', 64))
+
+# Resolution pages are rasterized and tiled at. Tiles are as wide as an
+# A4 page, 415 pixels at the default 50 DPI the models are trained on.
+TILE_DPI = int(os.environ.get('HKI_TILE_DPI', 50))
+
+# Number of PDF pages rasterized at a time
+RASTERIZE_PAGE_WINDOW = int(os.environ.get('HKI_RASTERIZE_PAGE_WINDOW', 8))
+
+# PDF rasterizer: pymupdf, pypdfium2, pdf2image, or auto for the first
+# installed in-process backend with pdf2image as the fallback. MuPDF and
+# PDFium are not thread-safe, so their calls are serialized within a
+# process: concurrent requests and jobs rasterize one at a time unless
+# HKI_RASTERIZE_WORKERS gives them a process pool.
+RASTERIZER = os.environ.get('HKI_RASTERIZER', 'auto')
+
+# Number of worker processes used for PDF rasterization, 0 rasterizes in
+# the request thread
+RASTERIZE_WORKERS = int(os.environ.get('HKI_RASTERIZE_WORKERS', 0))
+
+# Score all tiles of a page from a single backbone pass over the page
+# (hki_sig_ml.wholepage) instead of one pass per tile. Applies to models
+# served with the fastai backend.
+WHOLE_PAGE_INFERENCE = os.environ.get('HKI_WHOLE_PAGE_INFERENCE', '0') == '1'
+
+# Model checkpoint served by /analyze
+MODEL_PATH = os.environ.get('HKI_MODEL_PATH', '/app')
+MODEL_CHECKPOINT = os.environ.get('HKI_MODEL_CHECKPOINT', 'resnet34_data_aug_sigscale_best')
+MODEL_ARCHITECTURE = os.environ.get('HKI_MODEL_ARCHITECTURE', 'resnet34')
+# One of fastai, torchscript or onnx. The latter two serve the artifacts
+# written by python -m hki_sig_ml.export from MODEL_PATH. Quantized
+# artifacts from python -m hki_sig_ml.quantize are served with the
+# torchscript backend and a checkpoint name ending in _int8.
+MODEL_BACKEND = os.environ.get('HKI_MODEL_BACKEND', 'fastai')
+
+# Models requests can pick with ?model=<name>, as comma separated
+# name=checkpoint:architecture[:backend] entries, e.g.
+# resnet34=resnet34_data_aug_sigscale_best:resnet34,mobilenet=mobilenet_v2_best:mobilenet_v2:onnx
+# The first is the default. Unset serves the MODEL_* model under its
+# checkpoint name. Models other than the default are loaded on first
+# use, warmed up with a dummy batch if MODEL_WARMUP is set, and the
+# least recently used are unloaded once the loaded models take more than
+# MODEL_MEMORY_BUDGET bytes.
+MODELS = os.environ.get('HKI_MODELS') or f'{MODEL_CHECKPOINT}={MODEL_CHECKPOINT}:{MODEL_ARCHITECTURE}:{MODEL_BACKEND}'
+MODEL_MEMORY_BUDGET = int(os.environ.get('HKI_MODEL_MEMORY_BUDGET', 1024*1024*1024))
+MODEL_WARMUP = os.environ.get('HKI_MODEL_WARMUP', '1') == '1'
+
+# Page screening cascade: if SCREEN_CHECKPOINT is set, a page level
+# model scores SCREEN_WIDTH x SCREEN_HEIGHT thumbnails of each page, and
+# pages it labels as having no signature with at least SCREEN_THRESHOLD
+# confidence are not tiled. The screening model is loaded from
+# MODEL_PATH like the tile model.
+SCREEN_CHECKPOINT = os.environ.get('HKI_SCREEN_CHECKPOINT') or None
+SCREEN_ARCHITECTURE = os.environ.get('HKI_SCREEN_ARCHITECTURE', 'mobilenet_v2')
+SCREEN_BACKEND = os.environ.get('HKI_SCREEN_BACKEND', MODEL_BACKEND)
+SCREEN_THRESHOLD = float(os.environ.get('HKI_SCREEN_THRESHOLD', 0.9))
+SCREEN_WIDTH = int(os.environ.get('HKI_SCREEN_WIDTH', 414))
+SCREEN_HEIGHT = int(os.environ.get('HKI_SCREEN_HEIGHT', 585))
+SCREEN_BATCH_SIZE = int(os.environ.get('HKI_SCREEN_BATCH_SIZE', 16))
+
+# Result cache: number of documents kept in memory (0 disables the
+# in-memory tier), optional SQLite file for the on-disk tier and its
+# size (bytes) and age (seconds) limits
+CACHE_ENTRIES = int(os.environ.get('HKI_CACHE_ENTRIES', 256))
+CACHE_PATH = os.environ.get('HKI_CACHE_PATH') or None
+CACHE_MAX_BYTES = int(os.environ.get('HKI_CACHE_MAX_BYTES', 512*1024*1024))
+CACHE_MAX_AGE = float(os.environ.get('HKI_CACHE_MAX_AGE', 30*24*3600))
+
+# Background analysis jobs: number of worker threads, maximum number of
+# queued jobs before /jobs answers 429, and an optional redis:// URL for
+# a shared queue (in-process queue if unset)
+JOB_WORKERS = int(os.environ.get('HKI_JOB_WORKERS', 1))
+JOB_QUEUE_SIZE = int(os.environ.get('HKI_JOB_QUEUE_SIZE', 16))
+JOB_QUEUE_URL = os.environ.get('HKI_JOB_QUEUE_URL') or None
+
+# Maximum time in milliseconds a tile waits for other requests' tiles to
+# fill an inference batch. 0 runs each request's batches separately.
+INFERENCE_MAX_WAIT_MS = float(os.environ.get('HKI_INFERENCE_MAX_WAIT_MS', 0))
+
+# Blank tile prefilter: tiles with at most PREFILTER_MAX_INK_FRACTION of
+# pixels darker than PREFILTER_INK_THRESHOLD (and pixel standard
+# deviation at most PREFILTER_MAX_STD) are labeled as having no
+# signature with PREFILTER_CONFIDENCE without running the model
+PREFILTER_ENABLED = os.environ.get('HKI_PREFILTER_ENABLED', '0') == '1'
+PREFILTER_INK_THRESHOLD = int(os.environ.get('HKI_PREFILTER_INK_THRESHOLD', 200))
+PREFILTER_MAX_INK_FRACTION = float(os.environ.get('HKI_PREFILTER_MAX_INK_FRACTION', 0.002))
+PREFILTER_MAX_STD = float(os.environ.get('HKI_PREFILTER_MAX_STD', 8))
+PREFILTER_CONFIDENCE = float(os.environ.get('HKI_PREFILTER_CONFIDENCE', 0.99))
+
+# Stop scoring a page's tiles (bottom of the page first) once one is a
+# signature with at least this confidence. Unset scores every tile.
+EARLY_EXIT_THRESHOLD = os.environ.get('HKI_EARLY_EXIT_THRESHOLD')
+EARLY_EXIT_THRESHOLD = float(EARLY_EXIT_THRESHOLD) if EARLY_EXIT_THRESHOLD else None
+
+# Compress responses of at least COMPRESSION_MIN_BYTES (and streamed
+# responses) with brotli or gzip as negotiated with Accept-Encoding.
+# brotli needs the Brotli package.
+COMPRESSION_ENABLED = os.environ.get('HKI_COMPRESSION_ENABLED', '1') == '1'
+COMPRESSION_MIN_BYTES = int(os.environ.get('HKI_COMPRESSION_MIN_BYTES', 1024))
+
+# Start answering /health before the models are loaded. The fastai and
+# torch imports and model construction run on a background thread, /ready
+# answers 503 until they are done, and so does /analyze. Under gunicorn
+# every worker then loads its own copy of the models instead of sharing
+# the master's.
+FAST_START = os.environ.get('HKI_FAST_START', '0') == '1'
+
+# Production server (gunicorn.conf.py): number of pre-forked worker
+# processes, request threads per worker and torch intra-op threads per
+# worker (defaults to the cores divided between the workers). Without
+# HKI_JOB_QUEUE_URL, /jobs uses an in-process queue that only the worker
+# which accepted a job can answer for, so a single worker is the default
+# and more are refused by gunicorn.conf.py.
+WORKERS = int(os.environ.get('HKI_WORKERS',
+                             1 if JOB_QUEUE_URL is None else os.cpu_count() or 1))
+WORKER_THREADS = int(os.environ.get('HKI_WORKER_THREADS', 4))
+TORCH_THREADS = int(os.environ.get('HKI_TORCH_THREADS',
+                                   max(1, (os.cpu_count() or 1)//WORKERS)))
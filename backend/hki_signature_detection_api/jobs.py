@@ -0,0 +1,169 @@
+import collections
+import json
+import pickle
+import queue
+import threading
+import traceback
+import uuid
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class InProcessJobQueue:
+    """Bounded job queue and job state store living in the server process
+
+    At most max_size jobs wait in the queue at a time, and the state of
+    the max_jobs most recent jobs is kept for polling."""
+
+    def __init__(self, max_size:int=16, max_jobs:int=1000):
+        self._queue = queue.Queue(max_size)
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.max_jobs = max_jobs
+
+    def submit(self, payload):
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {'id': job_id, 'status': 'queued',
+                                  'pages_done': 0, 'pages_total': 0,
+                                  'error': None, 'result': None}
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        try:
+            self._queue.put_nowait((job_id, payload))
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            raise QueueFullError()
+        return job_id
+
+    def take(self, timeout:float=1.0):
+        # Return the next (job id, payload), or None if the queue stays
+        # empty for timeout seconds
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get(self, job_id:str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def update(self, job_id:str, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def increment(self, job_id:str, field:str, amount:int=1):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id][field] += amount
+
+
+class RedisJobQueue:
+    """Bounded job queue and job state store in Redis
+
+    Works with any client implementing the redis-py interface, so a
+    local Redis-compatible server can stand in for Redis. Job state
+    expires after ttl seconds."""
+
+    def __init__(self, client, max_size:int=16, prefix:str='hki:jobs',
+                 ttl:int=24*3600):
+        self.client = client
+        self.max_size = max_size
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url:str, **kwargs):
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def submit(self, payload):
+        # The length check and push are not atomic, so the queue can
+        # briefly exceed max_size under concurrent submits
+        if self.client.llen(self._key('queue')) >= self.max_size:
+            raise QueueFullError()
+        job_id = uuid.uuid4().hex
+        pipe = self.client.pipeline()
+        pipe.hset(self._key('job', job_id),
+                  mapping={'id': job_id, 'status': 'queued',
+                           'pages_done': 0, 'pages_total': 0})
+        pipe.expire(self._key('job', job_id), self.ttl)
+        pipe.set(self._key('payload', job_id), pickle.dumps(payload), ex=self.ttl)
+        pipe.lpush(self._key('queue'), job_id)
+        pipe.execute()
+        return job_id
+
+    def take(self, timeout:float=1.0):
+        item = self.client.brpop(self._key('queue'), timeout=max(1, int(timeout)))
+        if item is None:
+            return None
+        job_id = item[1].decode('utf-8')
+        payload = self.client.get(self._key('payload', job_id))
+        self.client.delete(self._key('payload', job_id))
+        if payload is None:
+            return None
+        return job_id, pickle.loads(payload)
+
+    def get(self, job_id:str):
+        job = self.client.hgetall(self._key('job', job_id))
+        if not job:
+            return None
+        job = {key.decode('utf-8'): value.decode('utf-8')
+               for key, value in job.items()}
+        return {'id': job['id'],
+                'status': job['status'],
+                'pages_done': int(job['pages_done']),
+                'pages_total': int(job['pages_total']),
+                'error': job.get('error'),
+                'result': json.loads(job['result']) if 'result' in job else None}
+
+    def update(self, job_id:str, **fields):
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        fields = {key: value for key, value in fields.items() if value is not None}
+        self.client.hset(self._key('job', job_id), mapping=fields)
+
+    def increment(self, job_id:str, field:str, amount:int=1):
+        self.client.hincrby(self._key('job', job_id), field, amount)
+
+
+def create_job_queue(url:str=None, max_size:int=16):
+    # An in-process queue unless a redis:// URL is given
+    if url:
+        return RedisJobQueue.from_url(url, max_size=max_size)
+    return InProcessJobQueue(max_size=max_size)
+
+
+def _work(job_queue, handler):
+    while True:
+        item = job_queue.take()
+        if item is None:
+            continue
+        job_id, payload = item
+        job_queue.update(job_id, status='running')
+        try:
+            result = handler(job_id, payload)
+            job_queue.update(job_id, status='done', result=result)
+        except Exception as e:
+            traceback.print_exc()
+            job_queue.update(job_id, status='failed', error=str(e))
+
+
+def start_workers(job_queue, handler, num_workers:int=1):
+    # Run handler(job id, payload) for queued jobs on num_workers
+    # background threads. The handler's return value is stored as the
+    # job result.
+    workers = [threading.Thread(target=_work, args=(job_queue, handler),
+                                name=f'job-worker-{i}', daemon=True)
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    return workers
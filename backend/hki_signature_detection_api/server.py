@@ -5,14 +5,27 @@ from flask_cors import CORS
 from hki_signature_detection_api.api import DummyEndpoint
 from hki_signature_detection_api.api import HelloEndpoint
 from hki_signature_detection_api.api import AnalysisEndpoint
+from hki_signature_detection_api.api import JobsEndpoint, JobEndpoint
+from hki_signature_detection_api.api import start_background, start_job_workers
+from hki_signature_detection_api.api import metrics
+from hki_signature_detection_api.api import health, ready, load_models
+from hki_signature_detection_api import config
+from hki_signature_detection_api.compression import compress_response
 
 API_VERSION_NUMBER = '1.0'
 API_VERSION_LABEL = 'v1'
 
 
 class SignatureDetectionApiApp:
-    def __init__(self):
+    def __init__(self, background:bool=True, fast_start:bool=False):
+        # With background=False, start_background must be called in each
+        # server process, e.g. after forking from a preloaded master.
+        # With fast_start, the models are loaded by start_background on
+        # a background thread instead of here, and /ready tells when
+        # they are loaded.
+        self.fast_start = fast_start
         self.app = Flask(__name__)
+        self.app.config['PROPAGATE_EXCEPTIONS'] = False
         CORS(self.app)
         custom_errors = {
             'JsonInvalidError': {
@@ -22,6 +35,18 @@ class SignatureDetectionApiApp:
             'JsonRequiredError': {
                 'status': 400,
                 'message': 'JSON input required'
+            },
+            'UnknownModelError': {
+                'status': 400,
+                'message': 'Unknown model'
+            },
+            'NotReadyError': {
+                'status': 503,
+                'message': 'Models are still loading, try again later'
+            },
+            'QueueFullError': {
+                'status': 429,
+                'message': 'Job queue full, try again later'
             }
         }
         self.api = swagger.docs(Api(self.app, errors=custom_errors), apiVersion=API_VERSION_NUMBER)
@@ -29,14 +54,30 @@ class SignatureDetectionApiApp:
         #self.api.add_resource(DummyEndpoint, '/dummy', endpoint='dummy')
         #self.api.add_resource(HelloEndpoint, '/hello', endpoint='hello')
         self.api.add_resource(AnalysisEndpoint, '/analyze', endpoint='analyze')
+        self.api.add_resource(JobsEndpoint, '/jobs', endpoint='jobs')
+        self.api.add_resource(JobEndpoint, '/jobs/<string:job_id>', endpoint='job')
+        self.app.add_url_rule('/metrics', 'metrics', metrics)
+        self.app.add_url_rule('/health', 'health', health)
+        self.app.add_url_rule('/ready', 'ready', ready)
+        if config.COMPRESSION_ENABLED:
+            self.app.after_request(
+                lambda response: compress_response(response, request.accept_encodings,
+                                                   config.COMPRESSION_MIN_BYTES))
+        if not fast_start:
+            load_models()
+        if background:
+            self.start_background()
+
+    def start_background(self):
+        start_background(self.fast_start)
+        start_job_workers()
 
     def run(self, *args, **kwargs):
-        self.app.config['PROPAGATE_EXCEPTIONS'] = False
         self.app.run(*args, **kwargs)
 
 
 def run_app(*args, **kwargs):
-    app = SignatureDetectionApiApp()
+    app = SignatureDetectionApiApp(fast_start=config.FAST_START)
     app.run(*args, **kwargs)
 
 
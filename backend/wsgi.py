@@ -0,0 +1,13 @@
+from hki_signature_detection_api import config
+from hki_signature_detection_api.server import SignatureDetectionApiApp
+
+# WSGI entry point for a pre-fork server. The model is loaded when this
+# module is imported, so with gunicorn's preload_app it is loaded once
+# in the master and shared copy-on-write with the forked workers
+# (gunicorn.conf.py keeps the master's torch single-threaded so that the
+# workers can fork safely).
+# Background threads are started per worker in gunicorn.conf.py. With
+# HKI_FAST_START=1 the model is instead loaded in each worker after it
+# starts serving /health.
+server = SignatureDetectionApiApp(background=False, fast_start=config.FAST_START)
+app = server.app
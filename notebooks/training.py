@@ -1,12 +1,18 @@
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import io
 import itertools
+import json
+import os
+import math
 from pathlib import Path
 import random
 
 from fastai.data.block import TransformBlock
 from fastai.data.transforms import get_files, IntToFloatTensor
 from fastai.torch_core import TensorCategory
-from fastai.vision.core import PILImage, PILImageBW
+from fastai.vision.core import PILImage, PILImageBW, TensorImage
 from fastcore.foundation import L
 from fastcore.transform import ItemTransform
 from joblib import Memory
@@ -16,6 +22,8 @@ from PIL import Image, ImageFilter, ImageOps
 import scipy.stats
 from tqdm import tqdm
 from cairosvg import svg2png
+import torch
+import torch.nn.functional as F
 
 
 #memory = Memory('.joblib_cache')
@@ -23,6 +31,7 @@ from cairosvg import svg2png
 convert_pdf = convert_from_path
 
 def get_tiles(image: Image, tile_size: int):
+    # image is anything with a width and height, e.g. a PIL image or a PageSize
     n_x, n_y = int(np.ceil(image.width/tile_size)), int(np.ceil(image.height/tile_size))
     offset_x = np.linspace(0, image.width-tile_size, n_x).astype(int)
     offset_y = np.linspace(0, image.height-tile_size, n_y).astype(int)
@@ -34,29 +43,116 @@ def get_tiles(image: Image, tile_size: int):
     return positions
 
 
-def get_document_tiles(pdf_directory, dpi=50):
+PageSize = collections.namedtuple('PageSize', ['width', 'height'])
+
+
+def _read_page_sizes(pdf_bytes: bytes, box: str='mediaBox'):
+    # (width, height) in points of each page as rendered, i.e. after /Rotate
+    from PyPDF4 import PdfFileReader
+
+    reader = PdfFileReader(io.BytesIO(pdf_bytes), strict=False)
+    if reader.isEncrypted:
+        reader.decrypt('')
+    sizes = []
+    for i in range(reader.getNumPages()):
+        page = reader.getPage(i)
+        page_box = getattr(page, box)
+        width, height = float(page_box.getWidth()), float(page_box.getHeight())
+        if '/Rotate' in page and int(page['/Rotate']) % 180 == 90:
+            width, height = height, width
+        sizes.append([width, height])
+    return sizes
+
+
+def _index_pdf(path: str, box: str='mediaBox', sha1: str=None):
+    # Index entry for a PDF, or None if its content still hashes to sha1
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        pdf_bytes = f.read()
+    digest = hashlib.sha1(pdf_bytes).hexdigest()
+    if digest == sha1:
+        return None
+    entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': digest}
+    try:
+        entry['pages'] = _read_page_sizes(pdf_bytes, box)
+    except Exception as error:
+        entry['error'] = str(error)
+    return entry
+
+
+def get_page_sizes(pdf_files, index_path=None, box: str='mediaBox', workers: int=None,
+                   check_hash: bool=False):
+    # Page sizes in points of each PDF from its page geometry, without
+    # rasterizing. Sizes are kept in the JSON index at index_path and
+    # reused while a file's mtime and size are unchanged (or, with
+    # check_hash, its content hash), the rest are read in parallel on
+    # workers processes. Returns a dict of path to index entry with the
+    # page sizes, or an error for unreadable files.
+    index = {}
+    if index_path is not None and Path(index_path).exists():
+        with open(index_path) as f:
+            stored = json.load(f)
+        if stored.get('box') == box:
+            index = stored['files']
+
+    files = {}
+    stale = []
+    for pdf in pdf_files:
+        path = str(pdf)
+        entry = index.get(path)
+        stat = os.stat(path)
+        if (entry is not None and not check_hash and entry['mtime_ns'] == stat.st_mtime_ns
+                and entry['size'] == stat.st_size):
+            files[path] = entry
+        else:
+            stale.append((path, None if entry is None else entry['sha1']))
+
+    if stale:
+        with ProcessPoolExecutor(workers) as pool:
+            entries = pool.map(_index_pdf, [path for path, _ in stale],
+                               itertools.repeat(box), [sha1 for _, sha1 in stale],
+                               chunksize=16)
+            for (path, _), entry in zip(stale, tqdm(entries, total=len(stale))):
+                if entry is None:
+                    # Unchanged content with a new mtime
+                    stat = os.stat(path)
+                    entry = dict(index[path], mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+                files[path] = entry
+
+    if index_path is not None and (stale or len(files) != len(index)):
+        tmp = Path(f'{index_path}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'box': box, 'files': files}, f)
+        os.replace(tmp, index_path)
+    return files
+
+
+def get_document_tiles(pdf_directory, dpi=50, index_path='.tile_index.json', workers=None):
+    # Tile specs for every page, with page sizes read from the PDF page
+    # geometry (see get_page_sizes) as pdf2image would render them at dpi
     pdf_files = get_files(pdf_directory, extensions=['.pdf'])
 
     # Split each page into square tiles with side length equal to
     # A4 width
     a4_width = 8.3
-    dpi = 50
     tile_size = int(a4_width*dpi) 
     pdf_tiles = []
 
-    #print(f'Checking PDF files in {pdf_directory}', flush=True)
-    for pdf in tqdm(pdf_files):
-        try:
-            pages = convert_from_path(pdf, dpi=dpi)
-            for i, page in enumerate(pages):
-                for j, tile in enumerate(get_tiles(page, tile_size)):
-                    pdf_tiles.append({'path': pdf, 
-                                      'page': i, 
-                                      'size': [page.width, page.height],
-                                      'tile': j,
-                                      'tile_edges': tile})
-        except Exception as error:
-            print('Unable to open', pdf, 'because', error)
+    page_sizes = get_page_sizes(pdf_files, index_path, workers=workers)
+    for pdf in pdf_files:
+        entry = page_sizes[str(pdf)]
+        if 'error' in entry:
+            print('Unable to open', pdf, 'because', entry['error'])
+            continue
+        for i, (width, height) in enumerate(entry['pages']):
+            # pdftoppm rounds the page size in pixels up
+            page = PageSize(math.ceil(width*dpi/72), math.ceil(height*dpi/72))
+            for j, tile in enumerate(get_tiles(page, tile_size)):
+                pdf_tiles.append({'path': pdf, 
+                                  'page': i, 
+                                  'size': [page.width, page.height],
+                                  'tile': j,
+                                  'tile_edges': tile})
    
     dummy_labels = np.zeros(len(pdf_tiles)).astype(int)
     dummy_labels[-1] = 1
@@ -64,6 +160,113 @@ def get_document_tiles(pdf_directory, dpi=50):
     return list(zip(pdf_tiles, dummy_labels))
 
 
+def build_tile_store(pdf_directory, store_directory, dpi: int=50):
+    # Rasterize every page once and write all of its tiles into
+    # <store_directory>/tiles.u8, a (n_tiles, tile_size, tile_size, 3)
+    # uint8 array, with the tile specs in the same order in index.json
+    store_directory = Path(store_directory)
+    store_directory.mkdir(parents=True, exist_ok=True)
+    pdf_files = get_files(pdf_directory, extensions=['.pdf'])
+    tile_size = int(8.3*dpi)
+    index = []
+
+    with open(store_directory/'tiles.u8', 'wb') as f:
+        for pdf in tqdm(pdf_files):
+            try:
+                pages = convert_from_path(pdf, dpi=dpi)
+            except Exception as error:
+                print('Unable to open', pdf, 'because', error)
+                continue
+            for i, page in enumerate(pages):
+                page = page.convert('RGB')
+                for j, tile in enumerate(get_tiles(page, tile_size)):
+                    tile = {key: int(value) for key, value in tile.items()}
+                    crop = page.crop([tile['x_start'], tile['y_start'], tile['x_stop'], tile['y_stop']])
+                    f.write(np.asarray(crop, dtype=np.uint8).tobytes())
+                    index.append({'path': str(pdf),
+                                  'page': i,
+                                  'size': [page.width, page.height],
+                                  'tile': j,
+                                  'tile_edges': tile})
+
+    with open(store_directory/'index.json', 'w') as f:
+        json.dump({'dpi': dpi, 'tile_size': tile_size, 'tiles': index}, f)
+    return TileStore(store_directory)
+
+
+class TileStore:
+    """Tiles written by build_tile_store, read through a memory map
+
+    Indexing returns a view into the map, so reading a tile does not
+    copy it. The map is opened copy-on-write, so the views are writable
+    without changing the store. The store is called like
+    get_document_tiles, so use it in its place:
+
+        store = build_tile_store(document_root, 'tile_store')
+        db = DataBlock(blocks=[SyntheticImageBlock(signature_root, store=store), CategoryBlock(vocab=[0,1])],
+                       get_items=store,
+                       get_x=ItemGetter(0),
+                       get_y=ItemGetter(1), ...)
+
+    (A bound method does not work as get_items, DataBlock rebinds it to
+    itself.)
+    """
+
+    def __init__(self, store_directory):
+        self.store_directory = Path(store_directory)
+        with open(self.store_directory/'index.json') as f:
+            metadata = json.load(f)
+        self.dpi = metadata['dpi']
+        self.tile_size = metadata['tile_size']
+        self.index = metadata['tiles']
+        self._open()
+
+    def _open(self):
+        shape = (len(self.index), self.tile_size, self.tile_size, 3)
+        if not self.index:
+            self.tiles = np.zeros(shape, dtype=np.uint8)
+            return
+        self.tiles = np.memmap(self.store_directory/'tiles.u8', dtype=np.uint8,
+                               mode='c', shape=shape)
+
+    def __getstate__(self):
+        # Reopen the map in data loader worker processes instead of
+        # pickling the tiles
+        state = dict(self.__dict__)
+        del state['tiles']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self.tiles[i]
+
+    def __call__(self, source=None):
+        # Tile specs with dummy labels like get_document_tiles, for use
+        # as get_items of a DataBlock
+        pdf_tiles = [{**spec, 'store_index': i} for i, spec in enumerate(self.index)]
+        dummy_labels = np.zeros(len(pdf_tiles)).astype(int)
+        dummy_labels[-1] = 1
+        return list(zip(pdf_tiles, dummy_labels))
+
+
+def _is_valid_signature(img: Image, svg_path, verbose=False):
+    if img.mode != 'RGBA':
+        if verbose:
+            print(f'Discarding {svg_path} because it is missing an alpha channel (image mode {img.mode})')
+        return False
+    if (np.array(img.getchannel('A'))/255).mean() > 0.2:
+        if verbose:
+            print(f'Discarding {svg_path} because more than 20% of the alpha channel is white')
+        return False
+    return True
+
+
 def get_svg_signatures(svg_directory, verbose=False):
     svg_files = get_files(svg_directory, extensions=['.svg'])
     ok_files = []
@@ -71,14 +274,7 @@ def get_svg_signatures(svg_directory, verbose=False):
     for svg_path in tqdm(svg_files):
         try:
             img = Image.open(io.BytesIO(svg2png(url=str(svg_path))))
-            
-            if img.mode != 'RGBA':
-                if verbose:
-                    print(f'Discarding {svg_path} because it is missing an alpha channel (image mode {img.mode})')
-                continue
-            if (np.array(img.getchannel('A'))/255).mean() > 0.2:
-                if verbose:
-                    print(f'Discarding {svg_path} because more than 20% of the alpha channel is white')
+            if not _is_valid_signature(img, svg_path, verbose):
                 continue
                 
             aspect_ratio = img.height/img.width
@@ -88,6 +284,155 @@ def get_svg_signatures(svg_directory, verbose=False):
     return L(ok_files)
 
 
+class SignatureSprites:
+    """Alpha masks of the valid signature SVGs, rasterized once
+
+    Each SVG is rendered once at the largest of widths, validated like
+    get_svg_signatures does, and downscaled to the other widths. These
+    canonical masks are packed into a single uint8 array. Masks at any
+    other width are resized from the nearest larger canonical mask and
+    kept in an LRU cache of max_cached masks.
+
+    sample() returns a random signature, augmented like
+    get_signature_image, at a random width like create_synthetic_image
+    draws. Signatures are drawn from a pool that is refilled pool_size
+    at a time, with dilation, erosion, rotation and colorization done
+    as tensor ops over the whole pool."""
+
+    def __init__(self, svg_directory, widths=(64, 128, 256), dpi: int=50,
+                 max_cached: int=1024, pool_size: int=32, prob_rotate: float=1.0,
+                 prob_colorize: float=0.5, prob_erode: float=0.0, prob_dilate: float=0.05,
+                 verbose=False):
+        self.widths = sorted(widths)
+        self.dpi = dpi
+        self.max_cached = max_cached
+        self.pool_size = pool_size
+        self.prob_rotate = prob_rotate
+        self.prob_colorize = prob_colorize
+        self.prob_erode = prob_erode
+        self.prob_dilate = prob_dilate
+        self.specs = L()
+        self._slots = []
+        self._cache = collections.OrderedDict()
+        self._pool = []
+        self._pool_pid = None
+
+        masks = []
+        offset = 0
+        print(f'Rasterizing SVG files in {svg_directory}', flush=True)
+        for svg_path in tqdm(get_files(svg_directory, extensions=['.svg'])):
+            try:
+                img = Image.open(io.BytesIO(svg2png(url=str(svg_path),
+                                                    output_width=self.widths[-1])))
+            except Exception as e:
+                print('Unable to open', svg_path, 'because', e)
+                continue
+            if not _is_valid_signature(img, svg_path, verbose):
+                continue
+            alpha = img.getchannel('A')
+            aspect_ratio = img.height/img.width
+            slots = []
+            for width in self.widths:
+                if width != alpha.width:
+                    mask = alpha.resize((width, max(1, int(width*aspect_ratio))), Image.LANCZOS)
+                else:
+                    mask = alpha
+                mask = np.asarray(mask, dtype=np.uint8)
+                masks.append(mask.ravel())
+                slots.append((offset, mask.shape))
+                offset += mask.size
+            self.specs.append({'path': svg_path, 'aspect_ratio': aspect_ratio})
+            self._slots.append(slots)
+        self._packed = np.concatenate(masks) if masks else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.specs)
+
+    def canonical_mask(self, i: int, k: int):
+        # View of the packed mask of signature i at widths[k]
+        offset, shape = self._slots[i][k]
+        return self._packed[offset:offset+shape[0]*shape[1]].reshape(shape)
+
+    def mask(self, i: int, width: int):
+        # Alpha mask of signature i at the given width
+        key = (i, width)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        k = min(np.searchsorted(self.widths, width), len(self.widths)-1)
+        mask = self.canonical_mask(i, k)
+        if mask.shape[1] != width:
+            height = max(1, int(width*self.specs[i]['aspect_ratio']))
+            mask = np.asarray(Image.fromarray(mask).resize((width, height), Image.BILINEAR))
+        self._cache[key] = mask
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return mask
+
+    def augment(self, masks: list):
+        # Augment a list of alpha masks together, returning HxWx4 uint8
+        # RGBA signatures cropped to their ink
+        n = len(masks)
+        side = int(np.ceil(max(np.hypot(*mask.shape) for mask in masks))) + 2
+        canvas = np.zeros((n, 1, side, side), dtype=np.float32)
+        for j, mask in enumerate(masks):
+            y, x = (side - mask.shape[0])//2, (side - mask.shape[1])//2
+            canvas[j, 0, y:y+mask.shape[0], x:x+mask.shape[1]] = mask
+        alpha = torch.from_numpy(canvas)/255.
+
+        # Dilation and erosion with a 3x3 max/min filter
+        dilate = torch.from_numpy(np.random.random(n) < self.prob_dilate)[:, None, None, None]
+        if dilate.any():
+            alpha = torch.where(dilate, F.max_pool2d(alpha, 3, 1, 1), alpha)
+        erode = torch.from_numpy(np.random.random(n) < self.prob_erode)[:, None, None, None]
+        if erode.any():
+            alpha = torch.where(erode, -F.max_pool2d(-alpha, 3, 1, 1), alpha)
+
+        # Rotation, angles drawn as in get_signature_image
+        rotate = np.random.random(n) < self.prob_rotate
+        if rotate.any():
+            loc = np.random.choice([0, -np.pi/2, np.pi/2, np.pi], size=n, p=[2/3, 1/9, 1/9, 1/9])
+            angles = np.where(rotate, scipy.stats.vonmises.rvs(loc=loc, kappa=4, size=n), 0.)
+            cos, sin, zeros = np.cos(angles), np.sin(angles), np.zeros(n)
+            theta = torch.tensor(np.stack([np.stack([cos, -sin, zeros], axis=1),
+                                           np.stack([sin, cos, zeros], axis=1)], axis=1),
+                                 dtype=torch.float32)
+            grid = F.affine_grid(theta, alpha.shape, align_corners=False)
+            alpha = F.grid_sample(alpha, grid, align_corners=False)
+
+        # Colorization, colors drawn as in get_signature_image
+        colors = (scipy.stats.triang.rvs(size=(n, 3), loc=0, c=0, scale=1)*255).astype(np.uint8)
+        colors[np.random.random(n) >= self.prob_colorize] = 0
+
+        alpha = (alpha[:, 0]*255).round().clamp(0, 255).to(torch.uint8).numpy()
+        sprites = []
+        for j in range(n):
+            ys, xs = np.nonzero(alpha[j])
+            if len(ys):
+                crop = alpha[j, ys.min():ys.max()+1, xs.min():xs.max()+1]
+            else:
+                crop = alpha[j]
+            sprite = np.empty(crop.shape + (4,), dtype=np.uint8)
+            sprite[..., :3] = colors[j]
+            sprite[..., 3] = crop
+            sprites.append(sprite)
+        return sprites
+
+    def _refill(self):
+        widths = (scipy.stats.uniform.rvs(loc=0.5, scale=4, size=self.pool_size)*self.dpi).astype(int)
+        indices = np.random.randint(len(self.specs), size=self.pool_size)
+        self._pool = self.augment([self.mask(i, width) for i, width in zip(indices, widths)])
+        self._pool_pid = os.getpid()
+
+    def sample(self):
+        # A random augmented signature as an RGBA image. Data loader
+        # workers refill their own pools rather than drawing the ones
+        # inherited from the parent process.
+        if not self._pool or self._pool_pid != os.getpid():
+            self._refill()
+        return Image.fromarray(self._pool.pop(), mode='RGBA')
+
+
 def get_signature_image(svg_spec: dict, width: int=100, prob_rotate: float=1.0,
                         prob_colorize: float=0.5, prob_erode: float=0.0, 
                         prob_dilate: float=0.05):
@@ -127,28 +472,56 @@ def get_signature_image(svg_spec: dict, width: int=100, prob_rotate: float=1.0,
     return bg
 
 
-def create_synthetic_image(doc_spec: dict, svg_specs: list, positive_prob: float=0.5, 
-                           dpi: int=50, image_cls=PILImage) -> None:
-    #print(doc_spec)
+def _render_tile(doc_spec: dict, dpi: int=50):
     doc_img = convert_pdf(pdf_path=doc_spec['path'],
                           dpi=dpi,
                           first_page=doc_spec['page']+1,
                           last_page=doc_spec['page']+1)[0]
     tile = doc_spec['tile_edges']
     tile = [tile['x_start'], tile['y_start'], tile['x_stop'], tile['y_stop']]
-    doc_img = doc_img.crop(tile)
+    return doc_img.crop(tile)
+
+
+def _tile_tensor(tile: np.ndarray):
+    # A channels first TensorImage sharing memory with the HxWx3 tile
+    return TensorImage(torch.from_numpy(tile).permute(2, 0, 1))
+
+
+def create_synthetic_image(doc_spec: dict, svg_specs: list, positive_prob: float=0.5, 
+                           dpi: int=50, image_cls=PILImage, store: TileStore=None,
+                           sprites: SignatureSprites=None) -> None:
+    # With a TileStore, the tile is read from it instead of rasterizing
+    # the page, and is only copied if a signature is pasted on it. With
+    # SignatureSprites, signatures come from it instead of svg_specs.
+    #print(doc_spec)
+    doc_img, tile = None, None
+    if store is not None:
+        tile = store[doc_spec['store_index']]
+        dpi = store.dpi
+    else:
+        doc_img = _render_tile(doc_spec, dpi)
     #svg_files = get_svg_signatures(svg_directory)
     label = 0
     if random.random() < positive_prob:
-        width_in = scipy.stats.uniform.rvs(loc=0.5, scale=4)
-        width = int(width_in*dpi)
-        #print('random sample', random.sample(svg_specs, k=1)[0])
-        sig_img = get_signature_image(random.sample(svg_specs, k=1)[0], width=width)
+        if doc_img is None:
+            doc_img = Image.fromarray(tile)
+        if sprites is not None:
+            sig_img = sprites.sample()
+        else:
+            width_in = scipy.stats.uniform.rvs(loc=0.5, scale=4)
+            width = int(width_in*dpi)
+            #print('random sample', random.sample(svg_specs, k=1)[0])
+            sig_img = get_signature_image(random.sample(svg_specs, k=1)[0], width=width)
 
         x = random.randint(-sig_img.width//2, doc_img.width-sig_img.width//2)
         y = random.randint(-sig_img.height//2, doc_img.height-sig_img.height//2)
         doc_img.paste(sig_img, [x,y], sig_img)
         label = 1
+
+    if doc_img is None:
+        if image_cls != PILImageBW:
+            return (_tile_tensor(tile), TensorCategory(label))
+        doc_img = Image.fromarray(tile)
         
     if image_cls == PILImageBW:
         doc_img = ImageOps.invert(ImageOps.grayscale(doc_img))# doc_img.convert('L')
@@ -156,26 +529,33 @@ def create_synthetic_image(doc_spec: dict, svg_specs: list, positive_prob: float
     return (image_cls.create(np.array(doc_img)), TensorCategory(label))
 
 
-def create_tile_image(doc_spec: dict, dpi: int=50) -> None:
-    doc_img = convert_pdf(pdf_path=doc_spec['path'],
-                          dpi=dpi,
-                          first_page=doc_spec['page']+1,
-                          last_page=doc_spec['page']+1)[0]
-    tile = doc_spec['tile_edges']
-    tile = [tile['x_start'], tile['y_start'], tile['x_stop'], tile['y_stop']]
-    doc_img = doc_img.crop(tile)
+def create_tile_image(doc_spec: dict, dpi: int=50, store: TileStore=None) -> None:
+    if store is not None:
+        return (_tile_tensor(store[doc_spec['store_index']]), TensorCategory(0))
+    doc_img = _render_tile(doc_spec, dpi)
 
     return (PILImage.create(np.array(doc_img)), TensorCategory(0))
 
 
-def SyntheticImageBlock(svg_directory: Path, positive_prob: float = 0.5, image_cls=PILImage):
-    svg_specs = get_svg_signatures(svg_directory)
-    return TransformBlock(type_tfms=lambda doc_spec: create_synthetic_image(doc_spec, svg_specs, positive_prob, image_cls=image_cls), 
+def SyntheticImageBlock(svg_directory: Path, positive_prob: float = 0.5, image_cls=PILImage,
+                        store: TileStore=None, sprites: SignatureSprites=None):
+    # Signatures come from SignatureSprites built from svg_directory
+    # unless sprites is given. sprites=False renders each signature
+    # from its SVG with get_signature_image instead.
+    if sprites is None:
+        sprites = SignatureSprites(svg_directory, dpi=store.dpi if store is not None else 50)
+    if sprites is False:
+        sprites = None
+        svg_specs = get_svg_signatures(svg_directory)
+    else:
+        svg_specs = sprites.specs
+    return TransformBlock(type_tfms=lambda doc_spec: create_synthetic_image(doc_spec, svg_specs, positive_prob, image_cls=image_cls, store=store, sprites=sprites), 
                           batch_tfms=IntToFloatTensor)
 
 
-def TileImagTransformBlock():
-    return TransformBlock(type_tfms=create_tile_image, batch_tfms=IntToFloatTensor)
+def TileImagTransformBlock(store: TileStore=None):
+    return TransformBlock(type_tfms=lambda doc_spec: create_tile_image(doc_spec, store=store),
+                          batch_tfms=IntToFloatTensor)
 
 
 class GetLabelFromX(ItemTransform):